@@ -1,9 +1,26 @@
+import math
+import os
 import pygame
-import pytmx
 import sys
 import random
 import time
 import sqlite3
+import threading
+import queue
+import hashlib
+import json
+import csv
+import bisect
+import mmap
+import struct
+from array import array
+from collections import OrderedDict, deque, namedtuple
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Без NumPy враги обновляются по одному через Mob.update
 
 WIDTH = 1000
 HEIGHT = 700
@@ -17,13 +34,966 @@ BLACK = (0, 0, 0)
 GRAY = (200, 200, 200)
 TOTAL_TIME = 0
 LEVEL_NUMBER = 0
+current_replay = None  # Запись текущего забега: от начала отсчета TOTAL_TIME до победы
+# Шагов симуляции в секунду. Скорости и гравитация заданы в целых пикселях на шаг, поэтому частота
+# не настраивается: при другой игра шла бы быстрее или медленнее, а время забега считалось бы иначе
+TICK_RATE = 60
+MAX_TICKS_PER_FRAME = 5  # Предел шагов за кадр, чтобы долгий кадр не вызвал лавину догоняющих шагов
+INTERPOLATE_RENDERING = True
+DIRTY_RENDERING = True  # Без движения камеры перерисовываются только области изменившихся спрайтов
+RENDER_SCALE = 1  # Масштаб внутреннего разрешения мира; кадр растягивается на все окно
+RENDER_SCALES = (1, 0.875, 0.75, 0.625, 0.5)  # Кратны 1/8: тайлы 32 пикселя и чанки остаются целыми
+ADAPTIVE_RESOLUTION = False  # Подбирать масштаб по времени кадра (переключается по F5)
+GOVERNOR_WINDOW = 30  # Кадров, по которым оценивается время кадра перед сменой масштаба
+GOVERNOR_LOWER = 0.9  # Масштаб снижается, если среднее время кадра выше этой доли бюджета 1 / FPS
+GOVERNOR_RAISE = 0.5  # и повышается, если ниже этой доли
+RECORDS_DB = "records.db"
+LEADERBOARD_SIZE = 5
+ENEMY_ACTIVATION_MARGIN = 320  # Запас вокруг камеры в пикселях, внутри которого враги симулируются полностью
+ENEMY_INACTIVE_MODE = "freeze"  # Дальние враги: "freeze" - стоят на месте, "coarse" - редкий грубый шаг
+ENEMY_COARSE_INTERVAL = 8  # В режиме "coarse" дальний враг шагает раз в столько шагов, сразу на весь интервал
+ENEMY_SIZE = 32  # Сторона кадра слайма в пикселях
+BATCH_ENEMIES = False  # Пакетная физика врагов на NumPy (MobSwarm) вместо Mob.update для каждого
+LOADING_MIN_DURATION = 1  # Минимальное время показа экрана загрузки в секундах
+LEVEL_CACHE_DIR = "maps/.cache"
+LEVEL_CACHE_VERSION = 3
+PROFILER_HISTORY = 600  # Сколько последних кадров хранит профайлер для статистики и выгрузки
+PROFILE_DUMP_PATH = "frame_profile.csv"  # Выгрузка по F4; расширение .json - выгрузка в JSON
+CHUNK_SIZE = 512  # Сторона чанка статичного слоя карты в пикселях
+CHUNK_CACHE_BUDGET = 32 * 1024 * 1024  # Байт на нарисованные чанки карты; дальние вытесняются (LRU)
+CHUNK_PREFETCH = 1  # Сколько чанков впереди по ходу камеры дорисовывается за кадр
+COLLISION_BAND = 4  # Ширина полосы CollisionGrid в столбцах тайлов
+COLLISION_BAND_BUDGET = 256  # Сколько разобранных полос каждая CollisionGrid уровня держит в памяти (LRU)
+SPATIAL_CELL = 128  # Сторона ячейки пространственного хеша спрайтов в пикселях
+TEXT_CACHE_BUDGET = 4 * 1024 * 1024  # Байт на отрисованные надписи; давно не нужные вытесняются (LRU)
+# Объекты карты создаются, когда их место подходит к камере, и выгружаются, когда камера уходит далеко;
+# враги - только в режиме "freeze" (см. Level.spawn_objects и Level.despawn_objects)
+STREAM_SPAWNS = True
+DESPAWN_MARGIN = 640  # Насколько дальше области активации по горизонтали должен уйти объект для выгрузки
+DESPAWN_INTERVAL = 30  # Раз в столько шагов ищутся объекты для выгрузки
 LEVELS = ['maps/FirstLevel.tmx', 'maps/SecondLevel.tmx', 'maps/ThirdLevel.tmx', 'maps/FourthLevel.tmx', 'maps/FifthLevel.tmx']
-pygame.init()
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Супер Малыш Хорек")
+INPUT_KEYS = {"a": pygame.K_a, "d": pygame.K_d, "w": pygame.K_w, "space": pygame.K_SPACE}
+INPUT_BITS = {key: 1 << index for index, key in enumerate(INPUT_KEYS.values())}
+screen = None
 clock = pygame.time.Clock()
 
 
+def init_display(headless=False):
+    """Создание окна игры, одного на все время работы. В режиме headless окно не открывается
+    (фиктивный видеодрайвер SDL). Звук и джойстики игре не нужны и не инициализируются."""
+    global screen
+    if screen is not None:
+        return screen
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Супер Малыш Хорек")
+    return screen
+
+
+class KeyState:
+    """Состояние управляющих клавиш за один шаг симуляции, упакованное в битовую маску."""
+
+    def __init__(self, mask=0):
+        self.mask = mask
+
+    @classmethod
+    def from_pressed(cls, pressed):
+        mask = 0
+        for key, bit in INPUT_BITS.items():
+            if pressed[key]:
+                mask |= bit
+        return cls(mask)
+
+    def __getitem__(self, key):
+        return bool(self.mask & INPUT_BITS.get(key, 0))
+
+
+def load_input_script(path):
+    """Чтение сценария ввода: строки вида "120 d+w" (число шагов и зажатые клавиши, "-" - ничего)."""
+    masks = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            ticks, pressed = line.split()
+            mask = 0
+            for name in pressed.split("+"):
+                if name != "-":
+                    mask |= INPUT_BITS[INPUT_KEYS[name]]
+            masks.extend([mask] * int(ticks))
+    return masks
+
+
+class Profiler:
+    """Замер времени по фазам кадра; выключенный профайлер почти ничего не стоит.
+
+    Кроме сумм по фазам хранит последние history кадров: из них считаются средние, перцентили
+    и худшие кадры для оверлея (F3), они же выгружаются в CSV или JSON (F4). Новые поверхности
+    считают сами места игры, где они создаются, вызовом count_surface()."""
+
+    OVERLAY_COLUMNS = (4, 100, 148, 196, 244, 292)
+
+    def __init__(self, enabled=False, history=PROFILER_HISTORY):
+        self.enabled = False
+        self.totals = {}  # фаза -> суммарное время в секундах
+        self.frames = 0
+        self.last_mark = 0
+        self.frame_start = None
+        self.phases = {}  # Фазы текущего кадра
+        self.history = deque(maxlen=history)  # (номер кадра, время кадра, фазы, новых поверхностей)
+        self.surfaces = 0  # Поверхностей создано в текущем кадре
+        self.overlay = None
+        self.overlay_updated = 0
+        self.font = None
+        self.set_enabled(enabled)
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            self.history.clear()
+            self.overlay = None
+            # Кадр, посреди которого включили профайлер, в статистику не попадает
+            self.frame_start = None
+            self.last_mark = time.perf_counter()
+        self.enabled = enabled
+
+    def count_surface(self, count=1):
+        """Учет новых поверхностей в текущем кадре."""
+        if self.enabled:
+            self.surfaces += count
+
+    def begin_frame(self):
+        if self.enabled:
+            self.frame_start = self.last_mark = time.perf_counter()
+            self.phases = {}
+            self.surfaces = 0
+
+    def mark(self, phase):
+        """Время с предыдущей отметки записывается в указанную фазу."""
+        if self.enabled:
+            now = time.perf_counter()
+            elapsed = now - self.last_mark
+            self.totals[phase] = self.totals.get(phase, 0) + elapsed
+            self.phases[phase] = self.phases.get(phase, 0) + elapsed
+            self.last_mark = now
+
+    def end_frame(self):
+        if self.enabled and self.frame_start is not None:
+            self.frames += 1
+            self.history.append((self.frames, time.perf_counter() - self.frame_start, self.phases, self.surfaces))
+
+    def stats(self, worst=3):
+        """Статистика по сохраненным кадрам в миллисекундах: среднее, p50, p95, p99 и максимум
+        для всего кадра и каждой фазы, худшие кадры и среднее число новых поверхностей."""
+        if not self.history:
+            return None
+
+        def summary(values):
+            values = sorted(values)
+            last = len(values) - 1
+            return {"avg": sum(values) / len(values) * 1000,
+                    "p50": values[last // 2] * 1000,
+                    "p95": values[last * 95 // 100] * 1000,
+                    "p99": values[last * 99 // 100] * 1000,
+                    "max": values[-1] * 1000}
+
+        names = sorted({phase for _, _, phases, _ in self.history for phase in phases})
+        return {
+            "frame": summary([total for _, total, _, _ in self.history]),
+            "phases": {phase: summary([phases.get(phase, 0) for _, _, phases, _ in self.history])
+                       for phase in names},
+            "worst": sorted(self.history, key=lambda frame: frame[1], reverse=True)[:worst],
+            "surfaces": sum(count for _, _, _, count in self.history) / len(self.history),
+        }
+
+    def dump(self, path):
+        """Выгрузка сохраненных кадров: JSON для файла .json, иначе CSV (время в миллисекундах)."""
+        names = sorted({phase for _, _, phases, _ in self.history for phase in phases})
+        rows = [dict({"frame": number, "total_ms": total * 1000, "surfaces": surfaces},
+                     **{phase: phases.get(phase, 0) * 1000 for phase in names})
+                for number, total, phases, surfaces in self.history]
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            if path.endswith(".json"):
+                json.dump(rows, file, indent=1)
+            else:
+                writer = csv.DictWriter(file, ["frame", "total_ms", "surfaces"] + names)
+                writer.writeheader()
+                writer.writerows(rows)
+
+    def draw_overlay(self, surface):
+        """Оверлей со статистикой в левом верхнем углу; текст обновляется несколько раз в секунду.
+        Возвращает занятый прямоугольник."""
+        now = time.perf_counter()
+        if self.overlay is None or now - self.overlay_updated > 0.25:
+            self.overlay_updated = now
+            self.overlay = self.render_overlay()
+        return surface.blit(self.overlay, (0, 0))
+
+    def render_overlay(self):
+        self.font = text_cache.font(20)
+        stats = self.stats()
+        rows = [["профайлер: нет кадров"]]  # Строка таблицы - ячейки в колонках OVERLAY_COLUMNS
+        if stats is not None:
+            keys = ("avg", "p50", "p95", "p99", "max")
+            rows = [["мс"] + list(keys),
+                    ["кадр"] + ["{0:.2f}".format(stats["frame"][key]) for key in keys]]
+            rows += [[phase] + ["{0:.2f}".format(values[key]) for key in keys]
+                     for phase, values in stats["phases"].items()]
+            rows.append(["поверхностей за кадр: {0:.1f}".format(stats["surfaces"])])
+            budget = render_governor.stats()
+            rows.append(["разрешение x{0:g}{1}, кадр {2:.1f} из {3:.1f} мс".format(
+                budget["scale"], " авто" if budget["adaptive"] else "", budget["avg_ms"], budget["budget_ms"])])
+            for number, total, phases, _ in stats["worst"]:
+                slowest = max(phases, key=phases.get) if phases else "-"
+                rows.append(["кадр {0}: {1:.2f} мс, больше всего {2}".format(number, total * 1000, slowest)])
+        line_height = self.font.get_linesize()
+        # Оверлей не уменьшается, иначе под ним на экране остался бы старый текст
+        height = max(line_height * len(rows) + 8, self.overlay.get_height() if self.overlay else 0)
+        overlay = pygame.Surface((340, height))
+        for index, row in enumerate(rows):
+            for column, cell in zip(self.OVERLAY_COLUMNS, row):
+                overlay.blit(self.font.render(cell, True, WHITE), (column, 4 + index * line_height))
+        return overlay
+
+
+game_profiler = Profiler()
+
+
+class ResolutionGovernor:
+    """Масштаб внутреннего разрешения мира и его подбор под бюджет кадра 1 / FPS.
+
+    Время работы кадров (без ожидания часов) копится в окне из window кадров. Когда окно заполнено,
+    слишком медленные кадры понижают масштаб на ступень из scales, а быстрые повышают его.
+    Растягивание кадра на окно тоже стоит времени: если понижение не ускорило кадры, масштаб
+    возвращается, и ниже него регулятор больше не спускается."""
+
+    def __init__(self, scales=RENDER_SCALES, scale=RENDER_SCALE, adaptive=ADAPTIVE_RESOLUTION,
+                 budget=1 / FPS, window=GOVERNOR_WINDOW):
+        self.scales = tuple(scales)
+        self.index = self.scales.index(scale)
+        self.adaptive = adaptive
+        self.budget = budget
+        self.frames = deque(maxlen=window)
+        self.lowest = len(self.scales) - 1  # Самая низкая ступень, до которой можно спуститься
+        self.lowered_from = None  # Среднее время кадра перед последним понижением масштаба
+        self.recorded = 0
+        self.over_budget = 0  # Кадров дольше бюджета за все время
+        self.changes = 0
+
+    @property
+    def scale(self):
+        return self.scales[self.index]
+
+    def set_scale(self, scale):
+        """Ручная установка масштаба из scales; окно замеров начинается заново."""
+        self.index = self.scales.index(scale)
+        self.frames.clear()
+
+    def set_adaptive(self, adaptive):
+        self.adaptive = adaptive
+        self.frames.clear()
+        self.lowest = len(self.scales) - 1
+        self.lowered_from = None
+        if not adaptive:
+            self.set_scale(RENDER_SCALE)
+
+    def record(self, frame_time):
+        """Учет времени кадра; возвращает True, если масштаб изменился."""
+        self.frames.append(frame_time)
+        self.recorded += 1
+        self.over_budget += frame_time > self.budget
+        if not self.adaptive or len(self.frames) < self.frames.maxlen:
+            return False
+        average = sum(self.frames) / len(self.frames)
+        lowered_from, self.lowered_from = self.lowered_from, None
+        if lowered_from is not None and average >= lowered_from * 0.95:
+            self.lowest = self.index - 1
+            self.index -= 1
+        elif average > self.budget * GOVERNOR_LOWER and self.index < self.lowest:
+            self.index += 1
+            self.lowered_from = average
+        elif average < self.budget * GOVERNOR_RAISE and self.index > 0:
+            self.index -= 1
+        else:
+            return False
+        # Новый масштаб оценивается по кадрам, нарисованным уже с ним
+        self.frames.clear()
+        self.changes += 1
+        return True
+
+    def stats(self):
+        frames = sorted(self.frames)
+        return {
+            "scale": self.scale,
+            "adaptive": self.adaptive,
+            "budget_ms": self.budget * 1000,
+            "avg_ms": sum(frames) / len(frames) * 1000 if frames else 0,
+            "p95_ms": frames[(len(frames) - 1) * 95 // 100] * 1000 if frames else 0,
+            "over_budget": self.over_budget / self.recorded if self.recorded else 0,
+            "changes": self.changes,
+        }
+
+
+render_governor = ResolutionGovernor()
+
+
+class Scene:
+    """Экран игры. Сцены не крутят свой цикл: событиями, часами и переходами управляет SceneManager."""
+
+    manager = None
+    dirty = True  # Следующий кадр нужно нарисовать целиком
+
+    def enter(self):
+        """Сцена стала активной."""
+
+    def handle_event(self, event):
+        pass
+
+    def update(self, dt):
+        pass
+
+    def draw(self, surface):
+        """Отрисовка кадра. Возвращает None, если нужно показать весь экран, или список измененных
+        прямоугольников; пустой список - кадр не изменился и вывод на экран не нужен."""
+
+    def invalidate(self):
+        """Содержимое окна потеряно (например, окно было перекрыто): нарисовать все заново."""
+        self.dirty = True
+
+    def close(self):
+        """Сцена покинута; здесь освобождаются ее ресурсы."""
+
+
+class MenuScene(Scene):
+    """Неподвижный экран: рисуется один раз, потом только после invalidate()."""
+
+    def draw(self, surface):
+        if not self.dirty:
+            return []
+        self.dirty = False
+        self.render(surface)
+        return None
+
+    def render(self, surface):
+        pass
+
+
+class SceneManager:
+    """Единственный главный цикл игры со стеком сцен."""
+
+    def __init__(self, scene):
+        self.stack = []
+        self.running = True
+        self.previous_time = time.perf_counter()
+        self.push(scene)
+
+    @property
+    def scene(self):
+        return self.stack[-1] if self.stack else None
+
+    def push(self, scene):
+        scene.manager = self
+        self.stack.append(scene)
+        scene.enter()
+
+    def pop(self):
+        scene = self.stack.pop()
+        scene.close()
+        scene.manager = None
+        return scene
+
+    def switch(self, scene):
+        """Замена текущей сцены; старая сцена закрывается и больше нигде не держится."""
+        if self.stack:
+            self.pop()
+        self.push(scene)
+
+    def quit(self):
+        self.running = False
+
+    def run(self):
+        self.previous_time = time.perf_counter()
+        while self.running and self.stack:
+            self.frame()
+            clock.tick(FPS)
+
+        while self.stack:
+            self.pop()
+
+    def frame(self):
+        """Один кадр: события, обновление и отрисовка текущей сцены."""
+        started = time.perf_counter()
+        scene = self.scene
+        game_profiler.begin_frame()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.quit()
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                self.scene.invalidate()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                game_profiler.set_enabled(not game_profiler.enabled)
+                self.scene.invalidate()  # Убрать оверлей с экрана
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and game_profiler.enabled:
+                game_profiler.dump(PROFILE_DUMP_PATH)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+                render_governor.set_adaptive(not render_governor.adaptive)
+            elif scene is self.scene:
+                scene.handle_event(event)
+        game_profiler.mark("events")
+
+        now = time.perf_counter()
+        dt = now - self.previous_time
+        self.previous_time = now
+        # Сцена, сменившаяся при обработке событий, начинает работу со следующего кадра
+        if self.running and scene is self.scene:
+            scene.update(dt)
+            game_profiler.mark("update")
+        if self.running and scene is self.scene:
+            dirty_rects = scene.draw(screen)
+            game_profiler.mark("draw")
+            if game_profiler.enabled:
+                overlay_rect = game_profiler.draw_overlay(screen)
+                if dirty_rects is not None:
+                    dirty_rects.append(overlay_rect)
+                game_profiler.mark("overlay")
+            if dirty_rects is None:
+                pygame.display.flip()
+            elif dirty_rects:
+                pygame.display.update(dirty_rects)
+            game_profiler.mark("flip")
+        game_profiler.end_frame()
+        render_governor.record(time.perf_counter() - started)
+
+
+def interpolate_rect(previous, current, alpha):
+    """Прямоугольник между двумя положениями объекта."""
+    if alpha >= 1 or previous == current:
+        return current
+    return current.move(round((previous.x - current.x) * (1 - alpha)),
+                        round((previous.y - current.y) * (1 - alpha)))
+
+
+class AssetManager:
+    """Общий кэш изображений: каждое изображение загружается, масштабируется и конвертируется один раз.
+
+    Кэшем пользуются и главный поток, и потоки LevelLoader. Словари меняются только под lock,
+    а сама загрузка идет без него; если два потока загрузили одно и то же, остается первая копия."""
+
+    def __init__(self):
+        self.assets = {}  # ключ -> Surface или ряды кадров анимации
+        self.groups = {}  # ключ -> группа, по которой ресурсы выгружаются
+        self.atlas_users = {}  # ключ атласа -> число уровней, которые его используют
+        self.lock = threading.Lock()
+
+    def store(self, key, value, group):
+        game_profiler.count_surface(sum(len(row) for row in value) if isinstance(value, list) else 1)
+        with self.lock:
+            if key not in self.assets:
+                self.assets[key] = value
+                self.groups[key] = group
+            return self.assets[key]
+
+    def image(self, path, size=None, alpha=True, flipped=False, group="sprites"):
+        key = ("image", path, size, alpha, flipped)
+        cached = self.assets.get(key)  # Одно обращение: между проверкой и чтением ключ могли бы выгрузить
+        if cached is not None:
+            return cached
+        if flipped:
+            # Отраженная копия строится один раз из обычного изображения
+            image = pygame.transform.flip(self.image(path, size, alpha, group=group), True, False)
+            return self.store(key, image, group)
+        image = pygame.image.load(path)
+        if size is not None:
+            image = pygame.transform.scale(image, size)
+        image = image.convert_alpha() if alpha else image.convert()
+        return self.store(key, image, group)
+
+    def frames(self, path, frame_width, frame_height, rows, cols, flipped=False, group="sprites"):
+        """Нарезанные кадры спрайт-листа, общие для всех экземпляров."""
+        key = ("frames", path, frame_width, frame_height, rows, cols, flipped)
+        cached = self.assets.get(key)
+        if cached is not None:
+            return cached
+        if flipped:
+            frames = [[pygame.transform.flip(frame, True, False) for frame in row]
+                      for row in self.frames(path, frame_width, frame_height, rows, cols, group=group)]
+            return self.store(key, frames, group)
+        sheet = self.image(path, group=group)
+        frames = []
+        for row in range(rows):
+            row_frames = []
+            for col in range(cols):
+                row_frames.append(sheet.subsurface((col * frame_width, row * frame_height,
+                                                    frame_width, frame_height)))
+            frames.append(row_frames)
+        return self.store(key, frames, group)
+
+    def atlas(self, tiles):
+        """Атлас с тайлами tiles (описания из LevelData.tiles). Подходит и готовый атлас другого уровня,
+        в котором есть все нужные тайлы; исходные тайлсеты в памяти не остаются.
+
+        Каждый полученный атлас нужно вернуть через release_atlas, когда уровень закрывается."""
+        tiles = frozenset(tiles)
+        with self.lock:
+            for key, value in self.assets.items():
+                if key[0] == "atlas" and tiles <= value.regions.keys():
+                    self.atlas_users[key] += 1
+                    return value
+        atlas = TileAtlas(tiles)
+        key = ("atlas", tiles)
+        with self.lock:
+            if key not in self.assets:
+                self.assets[key] = atlas
+                self.groups[key] = "atlases"
+                self.atlas_users[key] = 0
+            self.atlas_users[key] += 1
+            return self.assets[key]
+
+    def release_atlas(self, atlas):
+        """Уровень больше не использует атлас; атлас, которым не пользуется ни один уровень, выгружается."""
+        with self.lock:
+            for key, value in self.assets.items():
+                if value is atlas:
+                    self.atlas_users[key] -= 1
+                    if not self.atlas_users[key]:
+                        del self.assets[key]
+                        del self.groups[key]
+                        del self.atlas_users[key]
+                    return
+
+    def memory_usage(self):
+        """Объем пикселей в кэше в байтах; подповерхности делят память с родителем."""
+        total = 0
+        with self.lock:
+            values = list(self.assets.values())
+        for value in values:
+            if isinstance(value, TileAtlas):
+                value = value.surface
+            surfaces = [frame for row in value for frame in row] if isinstance(value, list) else [value]
+            for surface in surfaces:
+                if surface.get_parent() is None:
+                    total += surface.get_pitch() * surface.get_height()
+        return total
+
+    def evict(self, group=None):
+        """Выгрузка ресурсов группы (или всех ресурсов), возвращает число удаленных записей."""
+        with self.lock:
+            keys = [key for key, key_group in self.groups.items() if group is None or key_group == group]
+            for key in keys:
+                del self.assets[key]
+                del self.groups[key]
+                self.atlas_users.pop(key, None)
+        return len(keys)
+
+
+assets = AssetManager()
+
+
+class TileAtlas:
+    """Тайлы уровня, упакованные полками в одну поверхность экранного формата.
+
+    Из тайлсетов вырезаются только нужные тайлы, а тайлы уровня становятся подповерхностями атласа:
+    в памяти нет ни целых тайлсетов, ни отдельной поверхности на каждый тайл."""
+
+    def __init__(self, tiles):
+        import pytmx
+        from pytmx.util_pygame import handle_transformation, smart_convert
+
+        sources = {}
+        images = {}
+        self.unpacked_memory = 0  # Сколько занимали бы тайлсеты и отдельные поверхности тайлов
+        for tile in sorted(tiles, key=repr):
+            filename, rect, flags, colorkey = tile
+            if filename not in sources:
+                sources[filename] = pygame.image.load(filename)
+                self.unpacked_memory += sources[filename].get_pitch() * sources[filename].get_height()
+            image = sources[filename]
+            image = image.subsurface(rect) if rect else image.copy()
+            if flags:
+                image = handle_transformation(image, pytmx.TileFlags(*flags))
+            if colorkey:
+                colorkey = pygame.Color("#{0}".format(colorkey))
+            # Та же конвертация, что и у отдельных тайлов; colorkey и непрозрачность переходят в альфа-канал
+            image = smart_convert(image, colorkey, True)
+            self.unpacked_memory += image.get_pitch() * image.get_height()
+            images[tile] = image.convert_alpha()
+
+        # Полки по убыванию высоты; ширина - корень из общей площади, кратный самому широкому тайлу
+        order = sorted(images, key=lambda tile: -images[tile].get_height())
+        area = sum(image.get_width() * image.get_height() for image in images.values())
+        widest = max([image.get_width() for image in images.values()] + [1])
+        width = max(1, math.ceil(math.sqrt(area) / widest)) * widest
+        self.regions = {}  # Описание тайла -> прямоугольник в атласе
+        x = y = shelf = 0
+        for tile in order:
+            tile_width, tile_height = images[tile].get_size()
+            if x + tile_width > width:
+                x, y, shelf = 0, y + shelf, 0
+            self.regions[tile] = pygame.Rect(x, y, tile_width, tile_height)
+            x += tile_width
+            shelf = max(shelf, tile_height)
+
+        self.surface = pygame.Surface((width, max(1, y + shelf)), pygame.SRCALPHA).convert_alpha()
+        for tile, region in self.regions.items():
+            # Сложение с нулевым фоном копирует пиксели вместе с альфой, без смешивания
+            self.surface.blit(images[tile], region, special_flags=pygame.BLEND_RGBA_ADD)
+        self.memory = self.surface.get_pitch() * self.surface.get_height()
+
+    def image(self, tile):
+        return self.surface.subsurface(self.regions[tile])
+
+
+class TextCache:
+    """Общие шрифты и LRU-кэш отрисованных надписей с ограничением по памяти.
+
+    Надпись рисуется шрифтом один раз и дальше берется из кэша по (текст, размер, цвет, сглаживание),
+    поэтому кадры меню не растеризуют текст заново."""
+
+    def __init__(self, budget=TEXT_CACHE_BUDGET):
+        self.budget = budget
+        self.fonts = {}  # Размер -> pygame.font.Font
+        self.surfaces = OrderedDict()  # Ключ надписи -> Surface; в конце недавние
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, size):
+        """Шрифт по умолчанию нужного размера, один на всю игру."""
+        if size not in self.fonts:
+            self.fonts[size] = pygame.font.Font(None, size)
+        return self.fonts[size]
+
+    def render(self, text, size, color=BLACK, antialias=True):
+        key = (text, size, tuple(color), antialias)
+        if key in self.surfaces:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key]
+        self.misses += 1
+        surface = self.surfaces[key] = self.font(size).render(text, antialias, color)
+        game_profiler.count_surface()
+        self.memory += surface.get_pitch() * surface.get_height()
+        # Самые давние надписи вытесняются; только что нарисованная остается всегда
+        while self.memory > self.budget and len(self.surfaces) > 1:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.memory -= evicted.get_pitch() * evicted.get_height()
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.memory = 0
+
+
+text_cache = TextCache()
+
+
+MapObject = namedtuple("MapObject", "name x y")
+
+
+class LevelData:
+    """Скомпилированный уровень: сетки тайлов, классификация столкновений и список объектов."""
+
+    MAGIC = b"SMHLVL"
+    HEADER = struct.Struct("<6sII")  # сигнатура, версия формата, длина JSON-метаданных
+
+    def __init__(self, width, height, tilewidth, tileheight, layers, tiles, objects, blocked, platforms,
+                 sources=(), tile_counts=(0, 0), rect_counts=(0, 0), band=COLLISION_BAND):
+        self.width = width
+        self.height = height
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.layers = layers  # Видимые тайловые слои: gid pytmx по строкам, width * height значений
+        self.tiles = tiles  # gid -> (файл тайлсета, прямоугольник или None, флаги отражения, colorkey)
+        self.objects = objects
+        # Прямоугольники твердых тайлов (смежные тайлы объединены) и односторонних платформ (gid 162)
+        # по полосам CollisionGrid: (смещения полос, записи (номер, x, y, w, h)), см. CollisionGrid.pack
+        self.blocked = blocked
+        self.platforms = platforms
+        self.sources = sources  # (путь, sha1) исходных файлов, от которых собран уровень
+        self.tile_counts = tuple(tile_counts)  # Число твердых тайлов и тайлов платформ до объединения
+        self.rect_counts = tuple(rect_counts)  # Число прямоугольников твердых тайлов и платформ
+        self.band = band  # Ширина полосы в столбцах тайлов, с которой разложены прямоугольники
+        self.images = {}
+        self.atlas = None  # TileAtlas, из которого взяты images
+        self.mapping = None  # mmap файла кэша, если слои читаются прямо из него
+
+    @classmethod
+    def compile(cls, map_file):
+        """Разбор TMX через pytmx без загрузки пикселей: запоминается только, откуда брать каждый тайл."""
+        import pytmx  # Нужен только при сборке кэша уровня, поэтому не замедляет запуск игры
+
+        sources = {map_file}
+        for tileset in ElementTree.parse(map_file).getroot().iter("tileset"):
+            if tileset.get("source"):
+                sources.add(os.path.join(os.path.dirname(map_file), tileset.get("source")))
+
+        def image_loader(filename, colorkey, **kwargs):
+            sources.add(filename)
+            return lambda rect=None, flags=None: (filename, rect, tuple(flags) if flags else None, colorkey)
+
+        tmx_data = pytmx.TiledMap(map_file, image_loader=image_loader)
+        tiles = {gid: tile for gid, tile in enumerate(tmx_data.images) if tile}
+        layers = []
+        blocked = bytearray(tmx_data.width * tmx_data.height)
+        platforms = bytearray(tmx_data.width * tmx_data.height)
+        tile_counts = [0, 0]
+        for layer in tmx_data.visible_layers:
+            if hasattr(layer, 'data'):
+                grid = array('I', [0]) * (tmx_data.width * tmx_data.height)
+                for x, y, gid in layer:
+                    grid[y * tmx_data.width + x] = gid
+                    if gid in tiles:
+                        if gid != 162:
+                            blocked[y * tmx_data.width + x] = 1
+                            tile_counts[0] += 1
+                        else:
+                            platforms[y * tmx_data.width + x] = 1
+                            tile_counts[1] += 1
+                layers.append(grid)
+        objects = [MapObject(obj.name or "", obj.x, obj.y) for obj in tmx_data.objects]
+        size = (tmx_data.width, tmx_data.height, tmx_data.tilewidth, tmx_data.tileheight)
+        grids = []
+        for cells in (blocked, platforms):
+            grid = CollisionGrid(*size)
+            for rect in merge_tile_rects(cells, *size):
+                grid.add(pygame.Rect(rect))
+            grids.append(grid)
+        return cls(*size, layers, tiles, objects, grids[0].pack(), grids[1].pack(),
+                   sorted((os.path.abspath(path), file_hash(path)) for path in sources), tile_counts,
+                   (len(grids[0]), len(grids[1])), grids[0].band)
+
+    def save(self, path):
+        arrays = list(self.layers) + list(self.blocked) + list(self.platforms)
+        meta = {
+            "size": [self.width, self.height, self.tilewidth, self.tileheight],
+            "tiles": [[gid] + list(tile) for gid, tile in self.tiles.items()],
+            "objects": [list(obj) for obj in self.objects],
+            "sources": self.sources,
+            "tile_counts": self.tile_counts,
+            "rect_counts": self.rect_counts,
+            "band": self.band,
+            # Код типа и длина каждого массива: слои, затем смещения и записи полос твердых тайлов и платформ
+            "arrays": [[values.format if isinstance(values, memoryview) else values.typecode, len(values)]
+                       for values in arrays],
+        }
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        temp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(self.HEADER.pack(self.MAGIC, LEVEL_CACHE_VERSION, len(meta_bytes)))
+                file.write(meta_bytes)
+                for values in arrays:
+                    if sys.byteorder != "little":
+                        values = array(values.typecode, values)
+                        values.byteswap()
+                    values.tofile(file)
+            os.replace(temp_path, path)
+        except OSError:
+            # Например, старый файл кэша еще открыт живым уровнем: недописанный файл не остается в кэше
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @classmethod
+    def read(cls, path, map_file=None):
+        """Чтение скомпилированного уровня; None, если файл устарел, поврежден или собран не из map_file.
+
+        Слои и полосы столкновений остаются отображением файла в память до close(): пока уровень жив,
+        файл кэша открыт, а полосы читаются из него по мере того, как их запрашивает CollisionGrid."""
+        with open(path, "rb") as file:
+            # Слои не копируются в память процесса: их страницы подгружает ОС по мере обращения
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            level_data = cls.parse(data, map_file)
+        except BaseException:
+            data.close()
+            raise
+        if level_data is None:
+            data.close()
+        else:
+            level_data.mapping = data
+        return level_data
+
+    @classmethod
+    def parse(cls, data, map_file=None):
+        """Разбор содержимого файла кэша; слои и полосы столкновений - участки data без копирования."""
+        magic, version, meta_length = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != LEVEL_CACHE_VERSION:
+            return None
+        meta = json.loads(data[cls.HEADER.size:cls.HEADER.size + meta_length].decode("utf-8"))
+        if meta["band"] != COLLISION_BAND or len(meta["arrays"]) < 4:
+            return None
+        # Обрезанный или дописанный файл: массивы не сходятся с длиной файла
+        if cls.HEADER.size + meta_length + sum(length * array(typecode).itemsize for typecode, length
+                                               in meta["arrays"]) != len(data):
+            return None
+        if map_file is not None and level_path(map_file) not in {level_path(source) for source, _ in meta["sources"]}:
+            return None
+        for source, digest in meta["sources"]:
+            if not os.path.exists(source) or file_hash(source) != digest:
+                return None
+
+        tiles = {}
+        for gid, filename, rect, flags, colorkey in meta["tiles"]:
+            tiles[gid] = (filename, tuple(rect) if rect else None, tuple(flags) if flags else None, colorkey)
+        width, height, tilewidth, tileheight = meta["size"]
+        objects = [MapObject(*obj) for obj in meta["objects"]]
+
+        # Участки файла берутся последними: если разбор выше упадет, отображение можно сразу закрыть
+        offset = cls.HEADER.size + meta_length
+        arrays = []
+        try:
+            for typecode, length in meta["arrays"]:
+                values = array(typecode)
+                size = length * values.itemsize
+                if sys.byteorder == "little":
+                    arrays.append(memoryview(data)[offset:offset + size].cast(typecode))
+                else:
+                    values.frombytes(data[offset:offset + size])
+                    values.byteswap()
+                    arrays.append(values)
+                offset += size
+            return cls(width, height, tilewidth, tileheight, arrays[:-4], tiles, objects,
+                       tuple(arrays[-4:-2]), tuple(arrays[-2:]),
+                       [tuple(source) for source in meta["sources"]], meta["tile_counts"],
+                       meta["rect_counts"], meta["band"])
+        except BaseException:
+            # Участки файла отпускаются, иначе read() не сможет закрыть отображение
+            for values in arrays:
+                if isinstance(values, memoryview):
+                    values.release()
+            raise
+
+    def load_images(self):
+        """Изображения тайлов уровня - участки общего атласа из тех тайлов, что есть на его слоях."""
+        self.atlas = assets.atlas(self.tiles.values())
+        for gid, tile in self.tiles.items():
+            self.images[gid] = self.atlas.image(tile)
+        game_profiler.count_surface(len(self.images))
+
+    def close(self):
+        """Возврат атласа в общий кэш (без других уровней на нем он выгружается) и закрытие файла кэша.
+
+        Пока файл отображен в память, в Windows его нельзя заменить новой сборкой кэша."""
+        if self.atlas is not None:
+            assets.release_atlas(self.atlas)
+            self.atlas = None
+        self.images = {}
+        if self.mapping is not None:
+            for values in list(self.layers) + list(self.blocked) + list(self.platforms):
+                if isinstance(values, memoryview):
+                    values.release()
+            self.layers = []
+            self.blocked = self.platforms = (array('I', [0]), array('i'))
+            self.mapping.close()
+            self.mapping = None
+
+    def collision_grids(self):
+        """Сетки столкновений уровня (платформы, твердые тайлы); полосы читаются из кэша по запросам."""
+        size = (self.width, self.height, self.tilewidth, self.tileheight)
+        return (CollisionGrid(*size, band=self.band, source=self.platforms, count=self.rect_counts[1]),
+                CollisionGrid(*size, band=self.band, source=self.blocked, count=self.rect_counts[0]))
+
+    def get_tile_image_by_gid(self, gid):
+        return self.images.get(gid)
+
+    def iter_tiles(self):
+        """Непустые тайлы всех слоев по порядку: (x, y, gid)."""
+        for layer in self.layers:
+            for index, gid in enumerate(layer):
+                if gid:
+                    yield index % self.width, index // self.width, gid
+
+    def tiles_in(self, first_col, first_row, last_col, last_row):
+        """Непустые тайлы прямоугольной области сетки (границы включительно) в том же порядке,
+        что и iter_tiles: слой за слоем, по строкам."""
+        first_col = max(0, first_col)
+        first_row = max(0, first_row)
+        last_col = min(self.width - 1, last_col)
+        last_row = min(self.height - 1, last_row)
+        for layer in self.layers:
+            for y in range(first_row, last_row + 1):
+                start = y * self.width
+                for x, gid in enumerate(layer[start + first_col:start + last_col + 1], first_col):
+                    if gid:
+                        yield x, y, gid
+
+
+def merge_tile_rects(cells, width, height, tilewidth, tileheight):
+    """Жадное объединение занятых клеток сетки в прямоугольники (x, y, w, h) в пикселях.
+
+    Ряд занятых клеток растягивается вправо, затем прямоугольник растет вниз, пока следующая строка
+    занята на всю его ширину. Прямоугольники идут в порядке левых верхних углов по строкам,
+    как раньше шли отдельные тайлы.
+
+    Столкновения с ними дают тот же исход, что и с отдельными тайлами, пока тело за шаг поднимается
+    не больше чем на тайл и опускается меньше чем на тайл и свою высоту: для хорька и слайма на тайлах
+    в 32 пикселя это скорость от -32 до 62 (проверяет check_equivalence.py). Быстрее тело может
+    проскочить тайл целиком: тогда отдельный нижний тайл остановит его внутри столба, а объединенный
+    прямоугольник - на его верхней границе. Вверх тела движутся не быстрее прыжка (JUMP_STRENGTH),
+    а скорость 63 вниз набирается падением примерно с 63 тайлов, выше уровней игры (40 тайлов);
+    ниже карты тайлов нет."""
+    used = bytearray(len(cells))
+    rects = []
+    for y in range(height):
+        x = 0
+        while x < width:
+            start = y * width + x
+            if not cells[start] or used[start]:
+                x += 1
+                continue
+            end = x
+            while end < width and cells[y * width + end] and not used[y * width + end]:
+                end += 1
+            bottom = y + 1
+            while bottom < height and all(cells[bottom * width + col] and not used[bottom * width + col]
+                                          for col in range(x, end)):
+                bottom += 1
+            for row in range(y, bottom):
+                used[row * width + x:row * width + end] = b"\x01" * (end - x)
+            rects.append((x * tilewidth, y * tileheight, (end - x) * tilewidth, (bottom - y) * tileheight))
+            x = end
+    return rects
+
+
+def file_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def level_path(path):
+    """Нормализованный абсолютный путь: под ним файл карты однозначно определяет свой кэш."""
+    return os.path.normcase(os.path.abspath(path))
+
+
+def load_level_data(map_file):
+    """Данные уровня из скомпилированного кэша; при изменении карты или тайлсета кэш пересобирается.
+
+    Файл кэша назван по имени карты и хешу ее полного пути, поэтому одноименные карты
+    из разных каталогов не подменяют друг друга."""
+    path_hash = hashlib.sha1(level_path(map_file).encode("utf-8")).hexdigest()[:12]
+    cache_path = os.path.join(LEVEL_CACHE_DIR, "{0}.{1}.lvl".format(os.path.basename(map_file), path_hash))
+    if os.path.exists(cache_path):
+        try:
+            level_data = LevelData.read(cache_path, map_file)
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            # Поврежденный кэш считается устаревшим и собирается заново
+            level_data = None
+        if level_data is not None:
+            return level_data
+
+    level_data = LevelData.compile(map_file)
+    try:
+        os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+        level_data.save(cache_path)
+    except OSError:
+        pass  # Без кэша уровень все равно работает, просто грузится дольше
+    return level_data
+
+
 class Camera:
     def __init__(self, width, height):
         self.camera_rect = pygame.Rect(0, 0, width, height)
@@ -43,12 +1013,327 @@ class Camera:
         self.camera_rect = pygame.Rect(x, y, WIDTH, HEIGHT)
 
 
+class ChunkedMapRenderer:
+    """Статичные слои карты, отрисованные в чанки фиксированного размера.
+
+    Чанк рисуется, когда впервые попадает в кадр или в подгрузку по ходу камеры, и хранится
+    в LRU-кэше на budget байт. Память под чанки и время их отрисовки не зависят от размера уровня
+    (остальная загрузка уровня от него зависит, см. Level)."""
+
+    def __init__(self, tmx_data, chunk_size=CHUNK_SIZE, budget=CHUNK_CACHE_BUDGET, profiler=None):
+        self.tmx_data = tmx_data
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.profiler = profiler or game_profiler
+        self.width = tmx_data.width * tmx_data.tilewidth
+        self.height = tmx_data.height * tmx_data.tileheight
+        self.chunks = OrderedDict()  # (cx, cy) -> Surface или None для пустого; в конце недавние
+        self.scaled = {}  # (cx, cy) -> (масштаб, уменьшенная копия чанка); уходит вместе с чанком
+        self.memory = 0  # Байт в нарисованных чанках
+        self.baked = 0  # Сколько раз рисовались чанки, включая повторные после вытеснения
+        self.blank = pygame.Surface((chunk_size, chunk_size), pygame.SRCALPHA).convert_alpha()
+        self.chunk_bytes = chunk_size * chunk_size * self.blank.get_bytesize()
+        # Тайлы крупнее клетки сетки залезают в соседние чанки справа и снизу
+        images = [image for image in tmx_data.images.values() if image]
+        self.overhang_cols = (max([image.get_width() for image in images] + [1]) - 1) // tmx_data.tilewidth
+        self.overhang_rows = (max([image.get_height() for image in images] + [1]) - 1) // tmx_data.tileheight
+        self.last_camera = None
+
+    def bake(self, key):
+        """Отрисовка одного чанка из тайлов, которые его задевают."""
+        tmx_data = self.tmx_data
+        size = self.chunk_size
+        cx, cy = key
+        chunk = None
+        tiles = tmx_data.tiles_in(cx * size // tmx_data.tilewidth - self.overhang_cols,
+                                  cy * size // tmx_data.tileheight - self.overhang_rows,
+                                  ((cx + 1) * size - 1) // tmx_data.tilewidth,
+                                  ((cy + 1) * size - 1) // tmx_data.tileheight)
+        for x, y, gid in tiles:
+            tile = tmx_data.get_tile_image_by_gid(gid)
+            if not tile:
+                continue
+            px = x * tmx_data.tilewidth - cx * size
+            py = y * tmx_data.tileheight - cy * size
+            if px + tile.get_width() <= 0 or py + tile.get_height() <= 0:
+                continue
+            if chunk is None:
+                chunk = self.blank.copy()
+                self.profiler.count_surface()
+            chunk.blit(tile, (px, py))
+        self.baked += 1
+        return chunk
+
+    def chunk(self, key):
+        """Чанк из кэша или только что нарисованный; кэш ужимается до бюджета."""
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        chunk = self.chunks[key] = self.bake(key)
+        if chunk is not None:
+            self.memory += self.chunk_bytes
+            # Самые давние чанки вытесняются; только что нарисованный остается всегда
+            while self.memory > self.budget and len(self.chunks) > 1:
+                evicted_key, evicted = self.chunks.popitem(last=False)
+                self.scaled.pop(evicted_key, None)
+                if evicted is not None:
+                    self.memory -= self.chunk_bytes
+        return chunk
+
+    def scaled_chunk(self, key, scale):
+        """Чанк, уменьшенный до масштаба scale; копия хранится для одного масштаба."""
+        chunk = self.chunk(key)
+        if chunk is None:
+            return None
+        cached = self.scaled.get(key)
+        if cached is None or cached[0] != scale:
+            size = round(self.chunk_size * scale)
+            cached = self.scaled[key] = (scale, pygame.transform.smoothscale(chunk, (size, size)))
+            self.profiler.count_surface()
+        return cached[1]
+
+    def chunk_range(self, area):
+        size = self.chunk_size
+        first_cx = max(0, area.left // size)
+        first_cy = max(0, area.top // size)
+        last_cx = min(math.ceil(self.width / size), math.ceil(area.right / size))
+        last_cy = min(math.ceil(self.height / size), math.ceil(area.bottom / size))
+        return [(cx, cy) for cy in range(first_cy, last_cy) for cx in range(first_cx, last_cx)]
+
+    def draw(self, surface, camera_rect, scale=1):
+        """Отрисовка только тех чанков, которые пересекают область камеры; при scale меньше 1 -
+        уменьшенных копий чанков на поверхность внутреннего разрешения."""
+        size = self.chunk_size
+        if scale == 1:
+            for cx, cy in self.chunk_range(camera_rect):
+                chunk = self.chunk((cx, cy))
+                if chunk is not None:
+                    surface.blit(chunk, (cx * size - camera_rect.x, cy * size - camera_rect.y))
+            return
+        # Сдвиг камеры округляется один раз, чтобы между чанками не было щелей
+        step = round(size * scale)
+        offset_x = round(camera_rect.x * scale)
+        offset_y = round(camera_rect.y * scale)
+        for cx, cy in self.chunk_range(camera_rect):
+            chunk = self.scaled_chunk((cx, cy), scale)
+            if chunk is not None:
+                surface.blit(chunk, (cx * step - offset_x, cy * step - offset_y))
+
+    def prefetch(self, camera_rect, limit=CHUNK_PREFETCH):
+        """Дорисовка не более limit чанков, в которые камера въедет, если продолжит движение.
+        При первом вызове рисуются все чанки вокруг камеры."""
+        previous, self.last_camera = self.last_camera, camera_rect.copy()
+        if previous is None:
+            ahead = camera_rect.inflate(self.chunk_size, self.chunk_size)
+            limit = len(self.chunk_range(ahead))
+        else:
+            dx = (camera_rect.x > previous.x) - (camera_rect.x < previous.x)
+            dy = (camera_rect.y > previous.y) - (camera_rect.y < previous.y)
+            if not dx and not dy:
+                return
+            ahead = camera_rect.move(dx * self.chunk_size, dy * self.chunk_size)
+        for key in self.chunk_range(ahead):
+            if limit <= 0:
+                break
+            if key not in self.chunks:
+                self.chunk(key)
+                limit -= 1
+
+
+class CollisionGrid:
+    """Поиск прямоугольников столкновений рядом с объектом.
+
+    Прямоугольники разложены по вертикальным полосам в band столбцов тайлов, поэтому память растет
+    с числом прямоугольников, а не с площадью карты. Запрос отдает прямоугольники, задевающие клетки
+    тайлов, которые покрывает расширенная область объекта, как и поклеточная сетка.
+
+    Сетка уровня строится над полосами из файла кэша (source, см. pack): полоса разбирается при первом
+    запросе к ней, и в памяти остаются только budget последних нужных полос (LRU), так что ни загрузка,
+    ни память не растут с шириной карты. Сетка без source собирается через add."""
+
+    RECORD = 5  # Значений на прямоугольник в записях полос: номер, x, y, w, h
+
+    def __init__(self, width, height, cell_width, cell_height, band=COLLISION_BAND, source=None, count=0,
+                 budget=COLLISION_BAND_BUDGET):
+        self.cols = width
+        self.rows = height
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.band = band
+        self.source = source  # (смещения полос в записях, записи) или None
+        self.count = count
+        self.budget = budget
+        self.bands = OrderedDict()  # Номер полосы -> [(номер, Rect)] по номерам; пустые полосы не хранятся
+        self.loaded = 0  # Сколько раз полосы разбирались из source
+
+    def __len__(self):
+        return self.count
+
+    def cell_range(self, rect):
+        """Диапазоны столбцов и строк сетки, которые покрывает прямоугольник."""
+        first_col = max(0, rect.left // self.cell_width)
+        first_row = max(0, rect.top // self.cell_height)
+        last_col = min(self.cols - 1, (rect.right - 1) // self.cell_width)
+        last_row = min(self.rows - 1, (rect.bottom - 1) // self.cell_height)
+        return range(first_col, last_col + 1), range(first_row, last_row + 1)
+
+    def add(self, rect):
+        index = self.count
+        self.count += 1
+        cols, rows = self.cell_range(rect)
+        if cols and rows:
+            for band in range(cols.start // self.band, cols[-1] // self.band + 1):
+                self.bands.setdefault(band, []).append((index, rect))
+
+    def pack(self):
+        """Полосы для файла кэша: смещения полос (в записях) и записи всех полос подряд.
+
+        Прямоугольник, задевающий несколько полос, записан в каждую из них под своим номером."""
+        offsets = array('I', [0])
+        records = array('i')
+        for band in range(-(-self.cols // self.band)):
+            for index, rect in self.bands.get(band, ()):
+                records.extend((index, rect.x, rect.y, rect.width, rect.height))
+            offsets.append(len(records) // self.RECORD)
+        return offsets, records
+
+    def band_rects(self, band):
+        """Прямоугольники полосы; полоса из source разбирается при первом обращении."""
+        rects = self.bands.get(band)
+        if rects is not None:
+            if self.source is not None:
+                self.bands.move_to_end(band)
+            return rects
+        if self.source is None:
+            return ()
+        offsets, records = self.source
+        values = records[offsets[band] * self.RECORD:offsets[band + 1] * self.RECORD].tolist()
+        rects = [(values[start], pygame.Rect(values[start + 1:start + self.RECORD]))
+                 for start in range(0, len(values), self.RECORD)]
+        self.bands[band] = rects
+        self.loaded += 1
+        if len(self.bands) > self.budget:
+            self.bands.popitem(last=False)
+        return rects
+
+    def query(self, rect):
+        """Прямоугольники рядом с rect в порядке номеров."""
+        # Запас в размер объекта: при выталкивании он может сдвинуться в соседние клетки
+        area = rect.inflate(rect.width * 2, rect.height * 2)
+        cols, rows = self.cell_range(area)
+        if not cols or not rows:
+            return []
+        cells = pygame.Rect(cols.start * self.cell_width, rows.start * self.cell_height,
+                            len(cols) * self.cell_width, len(rows) * self.cell_height)
+        found = {}
+        for band in range(cols.start // self.band, cols[-1] // self.band + 1):
+            for index, tile in self.band_rects(band):
+                found[index] = tile
+        return [found[index] for index in sorted(found) if cells.colliderect(found[index])]
+
+
+class SpatialGroup(pygame.sprite.Group):
+    """Группа спрайтов с пространственным хешем по их прямоугольникам.
+
+    collide() смотрит только ячейки рядом с запрошенной областью и отдает спрайты в порядке группы,
+    как pygame.sprite.spritecollide. Спрайты, которые сдвинулись, передаются в relocate()."""
+
+    def __init__(self, *sprites, cell_size=SPATIAL_CELL):
+        self.cell_size = cell_size
+        self.buckets = {}  # (cx, cy) -> спрайты, задевающие ячейку
+        self.placed = {}  # Спрайт -> (номер добавления, границы ячеек)
+        self.added = 0
+        super().__init__(*sprites)
+
+    def cell_bounds(self, rect):
+        size = self.cell_size
+        return rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size
+
+    def cells(self, bounds):
+        left, top, right, bottom = bounds
+        return [(cx, cy) for cy in range(top, bottom + 1) for cx in range(left, right + 1)]
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        bounds = self.cell_bounds(sprite.rect)
+        self.placed[sprite] = (self.added, bounds)
+        self.added += 1
+        for cell in self.cells(bounds):
+            self.buckets.setdefault(cell, set()).add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        _, bounds = self.placed.pop(sprite)
+        self.unbucket(sprite, bounds)
+
+    def unbucket(self, sprite, bounds):
+        for cell in self.cells(bounds):
+            bucket = self.buckets[cell]
+            bucket.discard(sprite)
+            if not bucket:
+                del self.buckets[cell]
+
+    def relocate(self, sprites):
+        """Перенос сдвинувшихся спрайтов в их новые ячейки; спрайты не из группы пропускаются."""
+        for sprite in sprites:
+            if sprite not in self.placed:
+                continue
+            order, bounds = self.placed[sprite]
+            new_bounds = self.cell_bounds(sprite.rect)
+            if new_bounds == bounds:
+                continue
+            self.unbucket(sprite, bounds)
+            self.placed[sprite] = (order, new_bounds)
+            for cell in self.cells(new_bounds):
+                self.buckets.setdefault(cell, set()).add(sprite)
+
+    def collide(self, rect):
+        """Спрайты группы, пересекающие rect, в порядке группы."""
+        found = set()
+        for cell in self.cells(self.cell_bounds(rect)):
+            found.update(self.buckets.get(cell, ()))
+        hits = [sprite for sprite in found if rect.colliderect(sprite.rect)]
+        hits.sort(key=self.order)
+        return hits
+
+    def order(self, sprite):
+        """Место спрайта в порядке группы."""
+        return self.placed[sprite][0]
+
+
+class TriggerZones:
+    """Подписки на пересечения зоны (спрайта или прямоугольника) с группой целей SpatialGroup.
+
+    Уровень опрашивает подписки в нужном ему порядке через fire(): обработчик получает задетые
+    цели в порядке группы и может вернуть исход шага."""
+
+    def __init__(self):
+        self.subscriptions = {}  # Имя -> (зона, цели, обработчик)
+
+    def subscribe(self, name, zone, targets, handler):
+        self.subscriptions[name] = (zone, targets, handler)
+
+    def unsubscribe(self, name):
+        self.subscriptions.pop(name, None)
+
+    def fire(self, name):
+        """Проверка одной подписки; None, если зона ничего не задела или подписки нет."""
+        if name not in self.subscriptions:
+            return None
+        zone, targets, handler = self.subscriptions[name]
+        hits = targets.collide(getattr(zone, "rect", zone))
+        return handler(hits) if hits else None
+
+    def clear(self):
+        self.subscriptions.clear()
+
+
 class BabyFerret(pygame.sprite.Sprite):
     def __init__(self, x, y, tmx_data):
         super().__init__()
         self.tmx_data = tmx_data
-        self.original_image = pygame.image.load("sprites/Ferret.png")
-        self.original_image = pygame.transform.scale(self.original_image, (32, 32))
+        self.original_image = assets.image("sprites/Ferret.png", (32, 32))
+        self.flipped_image = assets.image("sprites/Ferret.png", (32, 32), flipped=True)
         self.image = self.original_image
         self.rect = self.image.get_rect(topleft=(x, y))
         self.velocity_y = 0
@@ -65,7 +1350,7 @@ class BabyFerret(pygame.sprite.Sprite):
     def handle_horizontal_movement(self, keys, blocked_tiles):
         if keys[pygame.K_a]:
             self.rect.x -= PLAYER_SPEED
-            self.image = pygame.transform.flip(self.original_image, True, False)
+            self.image = self.flipped_image
             self.handle_horizontal_collisions(blocked_tiles, "left")
 
         if keys[pygame.K_d]:
@@ -74,7 +1359,7 @@ class BabyFerret(pygame.sprite.Sprite):
             self.handle_horizontal_collisions(blocked_tiles, "right")
 
     def handle_horizontal_collisions(self, blocked_tiles, direction):
-        for tile in blocked_tiles:
+        for tile in blocked_tiles.query(self.rect):
             if self.rect.colliderect(tile):
                 if direction == "left":
                     self.rect.left = tile.right
@@ -88,13 +1373,13 @@ class BabyFerret(pygame.sprite.Sprite):
 
     def handle_vertical_collisions(self, platforms, blocked_tiles):
         self.on_ground = False
-        for platform in platforms:
+        for platform in platforms.query(self.rect):
             if self.rect.colliderect(platform) and self.velocity_y > 0:
                 self.rect.bottom = platform.top
                 self.velocity_y = 0
                 self.on_ground = True
 
-        for tile in blocked_tiles:
+        for tile in blocked_tiles.query(self.rect):
             if self.rect.colliderect(tile):
                 if self.velocity_y > 0:
                     self.rect.bottom = tile.top
@@ -129,13 +1414,24 @@ class BabyFerret(pygame.sprite.Sprite):
                 break
 
 
+def sweep(distance, limit):
+    """Путь distance кусками не длиннее limit, чтобы грубый шаг не проскочил сквозь тайл."""
+    pieces = []
+    while abs(distance) > limit:
+        piece = limit if distance > 0 else -limit
+        pieces.append(piece)
+        distance -= piece
+    pieces.append(distance)
+    return pieces
+
+
 class Mob(pygame.sprite.Sprite):
     def __init__(self, x, y, tmx_data):
         super().__init__()
         self.tmx_data = tmx_data
 
-        self.FRAME_WIDTH = 32
-        self.FRAME_HEIGHT = 32
+        self.FRAME_WIDTH = ENEMY_SIZE
+        self.FRAME_HEIGHT = ENEMY_SIZE
         self.ANIMATION_SPEED = 10
         self.DEATH_ANIMATION_SPEED = 5
         self.MOVE_SPEED = 2
@@ -145,9 +1441,10 @@ class Mob(pygame.sprite.Sprite):
         self.NUM_ROWS = 3
         self.NUM_COLS = 4
 
-        self.sprite_sheet = pygame.image.load("sprites/Slime.png").convert_alpha()
-        self.frames = []
-        self.load_frames()
+        self.frames = assets.frames("sprites/Slime.png", self.FRAME_WIDTH, self.FRAME_HEIGHT,
+                                    self.NUM_ROWS, self.NUM_COLS)
+        self.flipped_frames = assets.frames("sprites/Slime.png", self.FRAME_WIDTH, self.FRAME_HEIGHT,
+                                            self.NUM_ROWS, self.NUM_COLS, flipped=True)
 
         self.image = self.frames[self.LEFT_ANIMATION_ROW][0]
         self.rect = self.image.get_rect(topleft=(x, y))
@@ -156,97 +1453,323 @@ class Mob(pygame.sprite.Sprite):
         self.is_dead = False
         self.direction = 1  # 1 для движения вправо, -1 для влево
         self.velocity_y = 0
-
-    def load_frames(self):
-        for row in range(self.NUM_ROWS):
-            row_frames = []
-            for col in range(self.NUM_COLS):
-                frame = self.sprite_sheet.subsurface(
-                    (col * self.FRAME_WIDTH, row * self.FRAME_HEIGHT, self.FRAME_WIDTH, self.FRAME_HEIGHT)
-                )
-                row_frames.append(frame)
-            self.frames.append(row_frames)
-
-    def update(self, keys, platforms, blocked_tiles):
+        self.activation_slot = 0
+        self.swarm = None  # MobSwarm, если враг обновляется пакетно
+        self.swarm_index = None
+
+    def update(self, keys, platforms, blocked_tiles, ticks=1):
+        """Шаг врага. При ticks больше 1 - грубый шаг дальнего врага сразу за ticks шагов: падение идет
+        по скоростям этих шагов до первой опоры, а путь по горизонтали проходится одним-двумя кусками
+        (не длиннее тайла), и после удара о стену его остаток пропадает."""
         if self.is_dead:
             self.animate(self.DEATH_ANIMATION_ROW, self.DEATH_ANIMATION_SPEED)
             if self.frame_index == len(self.frames[self.DEATH_ANIMATION_ROW]) - 1:
                 self.kill()
             return
 
-        # Гравитация
-        self.velocity_y += GRAVITY
-        self.rect.y += self.velocity_y
+        # Гравитация и вертикальные столкновения; на опоре остальные шаги ничего бы не изменили
+        for _ in range(ticks):
+            self.velocity_y += GRAVITY
+            self.rect.y += self.velocity_y
+            if self.collide_vertically(blocked_tiles):
+                break
 
-        # Вертикальные столкновения
-        for tile in blocked_tiles:
+        # Горизонтальное движение
+        distance = self.direction * self.MOVE_SPEED * ticks
+        for part in sweep(distance, self.tmx_data.tilewidth):
+            self.rect.x += part
+            if self.collide_horizontally(blocked_tiles):
+                break
+
+        # Ограничение выхода за границы уровня
+        if self.rect.left <= 0 or self.rect.right >= self.tmx_data.width * self.tmx_data.tilewidth:
+            self.direction *= -1
+            self.frame_index = 0
+
+        # Анимация движения
+        self.animate(self.LEFT_ANIMATION_ROW, self.ANIMATION_SPEED, ticks)
+
+        # Поворот изображения при движении вправо
+        if self.direction > 0:
+            self.image = self.flipped_frames[self.LEFT_ANIMATION_ROW][self.frame_index]
+
+    def collide_vertically(self, blocked_tiles):
+        """Вертикальные столкновения; True, если враг во что-то уперся."""
+        hit = False
+        for tile in blocked_tiles.query(self.rect):
             if self.rect.colliderect(tile):
+                hit = True
                 if self.velocity_y > 0:
                     self.rect.bottom = tile.top
                     self.velocity_y = 0
                 elif self.velocity_y < 0:
                     self.rect.top = tile.bottom
                     self.velocity_y = 0
+        return hit
 
-        # Горизонтальное движение
-        self.rect.x += self.direction * self.MOVE_SPEED
-
-        # Горизонтальные столкновения
-        for tile in blocked_tiles:
+    def collide_horizontally(self, blocked_tiles):
+        """Горизонтальные столкновения с разворотом; True, если враг уперся в стену."""
+        hit = False
+        for tile in blocked_tiles.query(self.rect):
             if self.rect.colliderect(tile):
+                hit = True
                 if self.direction > 0:  # Движение вправо
                     self.rect.right = tile.left
                 elif self.direction < 0:  # Движение влево
                     self.rect.left = tile.right
                 self.direction *= -1
                 self.frame_index = 0  # Сброс анимации
+        return hit
 
-        # Ограничение выхода за границы уровня
-        if self.rect.left <= 0 or self.rect.right >= self.tmx_data.width * self.tmx_data.tilewidth:
-            self.direction *= -1
-            self.frame_index = 0
-
-        # Анимация движения
-        self.animate(self.LEFT_ANIMATION_ROW, self.ANIMATION_SPEED)
-
-        # Поворот изображения при движении вправо
-        if self.direction > 0:
-            self.image = pygame.transform.flip(self.image, True, False)
-
-    def animate(self, row, speed):
-        """Обработка анимации для указанного ряда кадров."""
+    def animate(self, row, speed, ticks=1):
+        """Обработка анимации для указанного ряда кадров за ticks шагов."""
         self.animation_timer += 1
         if self.animation_timer >= speed:
             self.animation_timer = 0
             self.frame_index = (self.frame_index + 1) % len(self.frames[row])
+        # Остальные шаги грубого шага: после первого таймер уже меньше speed
+        advance, self.animation_timer = divmod(self.animation_timer + ticks - 1, speed)
+        self.frame_index = (self.frame_index + advance) % len(self.frames[row])
         self.image = self.frames[row][self.frame_index]
 
     def die(self):
         """Перевод врага в состояние смерти."""
         self.is_dead = True
         self.frame_index = 0  # Сброс анимации на начало
+        if self.swarm is not None:
+            self.swarm.die(self.swarm_index)
+
+
+class MobSwarm:
+    """Пакетная физика врагов: состояние всех слаймов в массивах NumPy, шаг повторяет Mob.update."""
+
+    def __init__(self, mobs, tmx_data):
+        mobs = list(mobs)
+        # Константы анимации и движения одинаковы у всех врагов; без врагов их дает враг-образец
+        mob = mobs[0] if mobs else Mob(0, 0, tmx_data)
+        self.mob = mob
+        self.width = mob.rect.width
+        self.height = mob.rect.height
+        self.tilewidth = tmx_data.tilewidth
+        self.tileheight = tmx_data.tileheight
+        self.cols = tmx_data.width
+        self.rows = tmx_data.height
+        self.level_width = tmx_data.width * tmx_data.tilewidth
+
+        self.mobs = []
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        self.x = self.y = self.velocity_y = self.direction = empty
+        self.frame_index = self.animation_timer = self.slot = empty
+        self.dead = self.alive = numpy.zeros(0, dtype=bool)
+        self.add(mobs)
+
+        # Твердые клетки каждого слоя отдельно: CollisionGrid отдает тайлы слой за слоем, и здесь тот же порядок
+        solid_gids = numpy.array([gid for gid in tmx_data.tiles if gid != 162], dtype=numpy.uint32)
+        self.solid_layers = [numpy.isin(numpy.frombuffer(layer, numpy.uint32).reshape(self.rows, self.cols),
+                                        solid_gids)
+                             for layer in tmx_data.layers]
+
+    def add(self, mobs):
+        """Добавление врагов в конец массивов (например, когда они появляются рядом с камерой)."""
+        first = len(self.mobs)
+        self.mobs.extend(mobs)
+
+        def extend(values, new, dtype=numpy.int64):
+            return numpy.concatenate([values, numpy.array(new, dtype=dtype)])
+
+        self.x = extend(self.x, [mob.rect.x for mob in mobs])
+        self.y = extend(self.y, [mob.rect.y for mob in mobs])
+        self.velocity_y = extend(self.velocity_y, [mob.velocity_y for mob in mobs])
+        self.direction = extend(self.direction, [mob.direction for mob in mobs])
+        self.frame_index = extend(self.frame_index, [mob.frame_index for mob in mobs])
+        self.animation_timer = extend(self.animation_timer, [mob.animation_timer for mob in mobs])
+        self.slot = extend(self.slot, [mob.activation_slot for mob in mobs])
+        self.dead = extend(self.dead, [mob.is_dead for mob in mobs], bool)
+        self.alive = extend(self.alive, [True] * len(mobs), bool)  # False после kill()
+        for index, mob in enumerate(mobs, first):
+            mob.swarm = self
+            mob.swarm_index = index
+
+    def remove(self, mobs):
+        """Удаление врагов из массивов (например, выгруженных вдали от камеры); заодно уходят убитые."""
+        removed = set(mobs)
+        keep = self.alive & numpy.array([mob not in removed for mob in self.mobs], dtype=bool)
+        for mob, kept in zip(self.mobs, keep.tolist()):
+            if not kept:
+                mob.swarm = None
+                mob.swarm_index = None
+        self.mobs = [mob for mob, kept in zip(self.mobs, keep.tolist()) if kept]
+        for name in ("x", "y", "velocity_y", "direction", "frame_index", "animation_timer", "slot", "dead", "alive"):
+            setattr(self, name, getattr(self, name)[keep])
+        for index, mob in enumerate(self.mobs):
+            mob.swarm_index = index
+
+    def die(self, index):
+        self.dead[index] = True
+        self.frame_index[index] = 0
+
+    def steps(self, area, coarse, ticks):
+        """Сколько шагов проходит каждый враг на этом шаге (те же правила, что и в Level.step):
+        0 - стоит, 1 - обычный шаг, ENEMY_COARSE_INTERVAL - грубый шаг дальнего врага."""
+        near = ((self.x < area.right) & (self.x + self.width > area.left) &
+                (self.y < area.bottom) & (self.y + self.height > area.top))
+        steps = (self.dead | near).astype(numpy.int64)
+        if coarse:
+            due = (steps == 0) & ((ticks + self.slot) % ENEMY_COARSE_INTERVAL == 0)
+            steps[due] = ENEMY_COARSE_INTERVAL
+        steps[~self.alive] = 0
+        return steps
+
+    def update(self, steps):
+        index = numpy.flatnonzero(steps)
+        if not len(index):
+            return
+        mob = self.mob
+        dying = index[self.dead[index]]
+        moving = index[~self.dead[index]]
+        ticks = steps[moving]
+
+        # Анимация смерти
+        self.animate(dying, mob.DEATH_ANIMATION_SPEED)
+
+        # Гравитация и вертикальные столкновения: грубый шаг падает по шагам, пока враг не упрется
+        falling, left = moving, ticks
+        while len(falling):
+            self.velocity_y[falling] += GRAVITY
+            self.y[falling] += self.velocity_y[falling]
+            hit = self.collide(falling, vertical=True)
+            left = left - 1
+            falling, left = falling[~hit & (left > 0)], left[~hit & (left > 0)]
+
+        # Горизонтальное движение и столкновения кусками не длиннее тайла
+        index = moving
+        distance = self.direction[moving] * mob.MOVE_SPEED * ticks
+        while len(index):
+            part = numpy.clip(distance, -self.tilewidth, self.tilewidth)
+            self.x[index] += part
+            hit = self.collide(index, vertical=False)
+            distance = distance - part
+            index, distance = index[~hit & (distance != 0)], distance[~hit & (distance != 0)]
 
+        # Ограничение выхода за границы уровня
+        x = self.x[moving]
+        bounce = moving[(x <= 0) | (x + self.width >= self.level_width)]
+        self.direction[bounce] *= -1
+        self.frame_index[bounce] = 0
+
+        self.animate(moving, mob.ANIMATION_SPEED, ticks)
+        self.sync(dying, mob.DEATH_ANIMATION_ROW)
+        self.sync(moving, mob.LEFT_ANIMATION_ROW)
+
+    def animate(self, index, speed, ticks=1):
+        self.animation_timer[index] += 1
+        advance = index[self.animation_timer[index] >= speed]
+        self.animation_timer[advance] = 0
+        self.frame_index[advance] = (self.frame_index[advance] + 1) % self.mob.NUM_COLS
+        # Остальные шаги грубого шага, как в Mob.animate
+        advance, self.animation_timer[index] = numpy.divmod(self.animation_timer[index] + ticks - 1, speed)
+        self.frame_index[index] = (self.frame_index[index] + advance) % self.mob.NUM_COLS
+
+    def collide(self, index, vertical):
+        """Столкновения с тайлами в том же порядке проверок, что и цикл по CollisionGrid.query.
+        Возвращает, кто из врагов index во что-то уперся."""
+        x = self.x[index]
+        y = self.y[index]
+        velocity_y = self.velocity_y[index]
+        direction = self.direction[index]
+        frame_index = self.frame_index[index]
+        width, height = self.width, self.height
+        tilewidth, tileheight = self.tilewidth, self.tileheight
+
+        # Область запроса: прямоугольник, расширенный на свой размер, обрезанный по карте
+        first_col = numpy.maximum(0, (x - width) // tilewidth)
+        first_row = numpy.maximum(0, (y - height) // tileheight)
+        last_col = numpy.minimum(self.cols - 1, (x + 2 * width - 1) // tilewidth)
+        last_row = numpy.minimum(self.rows - 1, (y + 2 * height - 1) // tileheight)
+        span_cols = (3 * width - 1) // tilewidth + 2
+        span_rows = (3 * height - 1) // tileheight + 2
+        touched = numpy.zeros(len(index), dtype=bool)
+
+        for solid in self.solid_layers:
+            for row_offset in range(span_rows):
+                row = first_row + row_offset
+                for col_offset in range(span_cols):
+                    col = first_col + col_offset
+                    candidate = (row <= last_row) & (col <= last_col)
+                    candidate &= solid[numpy.minimum(row, self.rows - 1), numpy.minimum(col, self.cols - 1)]
+                    tile_left = col * tilewidth
+                    tile_top = row * tileheight
+                    hit = (candidate & (x < tile_left + tilewidth) & (x + width > tile_left) &
+                           (y < tile_top + tileheight) & (y + height > tile_top))
+                    if not hit.any():
+                        continue
+                    touched |= hit
+                    if vertical:
+                        down = hit & (velocity_y > 0)
+                        up = hit & (velocity_y < 0)
+                        y = numpy.where(down, tile_top - height, numpy.where(up, tile_top + tileheight, y))
+                        velocity_y = numpy.where(down | up, 0, velocity_y)
+                    else:
+                        x = numpy.where(hit & (direction > 0), tile_left - width,
+                                        numpy.where(hit & (direction < 0), tile_left + tilewidth, x))
+                        direction = numpy.where(hit, -direction, direction)
+                        frame_index = numpy.where(hit, 0, frame_index)
+
+        self.x[index] = x
+        self.y[index] = y
+        self.velocity_y[index] = velocity_y
+        self.direction[index] = direction
+        self.frame_index[index] = frame_index
+        return touched
+
+    def sync(self, index, row):
+        """Перенос состояния обновленных врагов в спрайты для отрисовки и столкновений с игроком."""
+        mob = self.mob
+        last_frame = mob.NUM_COLS - 1
+        for i, x, y, velocity_y, direction, frame_index, timer in zip(
+                index.tolist(), self.x[index].tolist(), self.y[index].tolist(), self.velocity_y[index].tolist(),
+                self.direction[index].tolist(), self.frame_index[index].tolist(),
+                self.animation_timer[index].tolist()):
+            sprite = self.mobs[i]
+            sprite.rect.x = x
+            sprite.rect.y = y
+            sprite.velocity_y = velocity_y
+            sprite.direction = direction
+            sprite.frame_index = frame_index
+            sprite.animation_timer = timer
+            if row == mob.DEATH_ANIMATION_ROW:
+                sprite.image = sprite.frames[row][frame_index]
+                if frame_index == last_frame:
+                    self.alive[i] = False
+                    sprite.kill()
+            elif direction > 0:
+                sprite.image = sprite.flipped_frames[row][frame_index]
+            else:
+                sprite.image = sprite.frames[row][frame_index]
 
-class Princess(pygame.sprite.Sprite):
-    def __init__(self, x, y, tmx_data):
+
+class RestingBody(pygame.sprite.Sprite):
+    """Тело под действием гравитации, которое засыпает, остановившись на опоре.
+    Спящее тело не обновляется, пока его не разбудят. Тайлы уровня не меняются, поэтому опора
+    не пропадает, и будит тело только встреча хорька с принцессой (Princess.run)."""
+
+    def __init__(self):
         super().__init__()
-        self.tmx_data = tmx_data
-        self.MOVE_SPEED = 2
-        self.original_image = pygame.image.load("sprites/Princess.png")
-        self.original_image = pygame.transform.scale(self.original_image, (32, 32))
-        self.image = self.original_image
-        self.rect = self.image.get_rect(topleft=(x, y))
-        self.direction = -1  # 1 для движения вправо, -1 для влево
         self.velocity_y = 0
-        self.running = False
-
+        self.sleeping = False
+        self.awake_group = None  # Группа уровня, через которую обновляются неспящие тела
 
     def update(self, keys, platforms, blocked_tiles):
+        position = self.rect.topleft
+        self.fall(blocked_tiles)
+        self.settle(position)
+
+    def fall(self, blocked_tiles):
         self.velocity_y += GRAVITY
         self.rect.y += self.velocity_y
 
         # Вертикальные столкновения
-        for tile in blocked_tiles:
+        for tile in blocked_tiles.query(self.rect):
             if self.rect.colliderect(tile):
                 if self.velocity_y > 0:
                     self.rect.bottom = tile.top
@@ -255,208 +1778,710 @@ class Princess(pygame.sprite.Sprite):
                     self.rect.top = tile.bottom
                     self.velocity_y = 0
 
+    def catch_up(self, ticks, blocked_tiles, level_bottom):
+        """Шаги, которые тело сделало бы за ticks шагов уровня, будь оно создано при загрузке.
+        Уснувшее тело дальше не меняется, а ниже карты опор нет: остаток падения считается сразу."""
+        while ticks > 0 and not self.sleeping:
+            if self.rect.top >= level_bottom:
+                self.rect.y += ticks * self.velocity_y + GRAVITY * ticks * (ticks + 1) // 2
+                self.velocity_y += ticks * GRAVITY
+                return
+            self.update(None, None, blocked_tiles)
+            ticks -= 1
+
+    def settle(self, position):
+        # Шаг на опоре вернул тело на то же место: следующие шаги тоже ничего не изменят
+        if self.rect.topleft == position and self.velocity_y == 0:
+            self.sleep()
+
+    def sleep(self):
+        self.sleeping = True
+        if self.awake_group is not None:
+            self.awake_group.remove(self)
+
+    def wake(self):
+        self.sleeping = False
+        if self.awake_group is not None:
+            self.awake_group.add(self)
+
+
+class Princess(RestingBody):
+    def __init__(self, x, y, tmx_data):
+        super().__init__()
+        self.tmx_data = tmx_data
+        self.MOVE_SPEED = 2
+        self.original_image = assets.image("sprites/Princess.png", (32, 32))
+        self.flipped_image = assets.image("sprites/Princess.png", (32, 32), flipped=True)
+        self.image = self.original_image
+        self.rect = self.image.get_rect(topleft=(x, y))
+        self.direction = -1  # 1 для движения вправо, -1 для влево
+        self.running = False
+
+    def update(self, keys, platforms, blocked_tiles):
+        position = self.rect.topleft
+        self.fall(blocked_tiles)
+
         if self.running:
             self.rect.x -= self.direction * self.MOVE_SPEED
-            self.image = pygame.transform.flip(self.original_image, True, False)
+            self.image = self.flipped_image
+        else:
+            self.settle(position)
 
     def run(self):
         self.running = True
+        self.wake()
 
 
-class Teleport(pygame.sprite.Sprite):
+class Teleport(RestingBody):
     def __init__(self, x, y, tmx_data):
         super().__init__()
-        self.image = pygame.image.load("sprites/Teleport.png")
-        self.image = pygame.transform.scale(self.image, (32, 32))
+        self.image = assets.image("sprites/Teleport.png", (32, 32))
         self.rect = self.image.get_rect(topleft=(x, y))
-        self.velocity_y = 0
         self.tmx_data = tmx_data
 
-    def update(self, keys, platforms, blocked_tiles):
-        self.velocity_y += GRAVITY
-        self.rect.y += self.velocity_y
 
-        for tile in blocked_tiles:
-            if self.rect.colliderect(tile):
-                if self.velocity_y > 0:
-                    self.rect.bottom = tile.top
-                    self.velocity_y = 0
-                elif self.velocity_y < 0:
-                    self.rect.top = tile.bottom
-                    self.velocity_y = 0
-
-
-class Thorn(pygame.sprite.Sprite):
+class Thorn(RestingBody):
     def __init__(self, x, y, tmx_data):
         super().__init__()
-        self.image = pygame.image.load("sprites/Thorns.png")
-        self.image = pygame.transform.scale(self.image, (32, 32))
+        self.image = assets.image("sprites/Thorns.png", (32, 32))
         self.rect = self.image.get_rect(topleft=(x, y))
-        self.velocity_y = 0
         self.tmx_data = tmx_data
 
-    def update(self, keys, platforms, blocked_tiles):
-        self.velocity_y += GRAVITY
-        self.rect.y += self.velocity_y
 
-        for tile in blocked_tiles:
-            if self.rect.colliderect(tile):
-                if self.velocity_y > 0:
-                    self.rect.bottom = tile.top
-                    self.velocity_y = 0
-                elif self.velocity_y < 0:
-                    self.rect.top = tile.bottom
-                    self.velocity_y = 0
+class Level(Scene):
+    """Уровень: карта, спрайты объектов, шаг симуляции и отрисовка.
 
+    По ходу камеры подгружаются картинка карты (ChunkedMapRenderer), полосы прямоугольников столкновений
+    (CollisionGrid) и объекты карты (STREAM_SPAWNS), а далекие объекты, которые без камеры не меняются,
+    выгружаются обратно. Слои тайлов читаются из отображенного в память кэша. С шириной карты по-прежнему
+    растут список точек появления (self.spawns, по кортежу на объект) и, при BATCH_ENEMIES, сетки
+    твердых клеток MobSwarm (байт на клетку слоя)."""
 
-class Level:
-    def __init__(self, map_file):
-        self.all_sprites = pygame.sprite.Group()
-        self.enemies = pygame.sprite.Group()
-        self.thorns = pygame.sprite.Group()
-        self.platforms = []
-        self.blocked_tiles = []
+    OBJECT_NAMES = ("Player", "Enemy", "Teleport", "Princess", "Shipi")
+
+    def __init__(self, map_file, profiler=None, progress=None):
+        progress = progress or (lambda value: None)
+        self.map_file = map_file
+        self.profiler = profiler or game_profiler
+        self.all_sprites = SpatialGroup()  # Все спрайты в порядке отрисовки; по хешу отбираются видимые
+        self.enemies = SpatialGroup()
+        self.thorns = SpatialGroup()
+        self.teleports = SpatialGroup()
+        self.princesses = SpatialGroup()
+        self.awake_thorns = pygame.sprite.Group()
         self.check = False
         self.check2 = False
         self.check_win = False
 
-        self.start_time = time.time()  # Время начала уровня
+        self.ticks = 0  # Время уровня считается в шагах симуляции, а не по настенным часам
         self.current_time = 0
-
-        self.tmx_data = pytmx.load_pygame(map_file)
-
-        for obj in self.tmx_data.objects:
-            if obj.name == "Player":
-                self.Ferret = BabyFerret(obj.x, obj.y, self.tmx_data)
-                self.all_sprites.add(self.Ferret)
+        self.accumulator = 0
+        self.alpha = 1
+
+        self.tmx_data = load_level_data(map_file)
+        # Тайлы берутся из атласа, общего для уровней с одинаковым набором тайлов
+        self.tmx_data.load_images()
+        progress(0.5)
+        self.platforms, self.blocked_tiles = self.tmx_data.collision_grids()
+
+        # Объекты создаются, когда камера к ним подходит (spawn_objects). Сразу создаются хорек, а также
+        # телепорт и принцесса, к которым он идет (последние объекты с этими именами): они нужны каждому
+        # шагу. Более ранние одноименные объекты - неподвижные украшения. Враги подгружаются только
+        # в режиме "freeze": неподвижный дальний враг ничем не отличается от еще не созданного
+        self.stream_spawns = STREAM_SPAWNS
+        self.stream_enemies = STREAM_SPAWNS and ENEMY_INACTIVE_MODE == "freeze"
+        self.spawns = []  # (x, порядковый номер объекта, номер врага, объект, состояние при выгрузке или None)
+        goals = {obj.name: order for order, obj in enumerate(self.tmx_data.objects)
+                 if obj.name in ("Player", "Teleport", "Princess")}
+        sprites = {}
+        enemy_count = 0
+        for order, obj in enumerate(self.tmx_data.objects):
+            number = enemy_count
             if obj.name == "Enemy":
-                enemy = Mob(obj.x, obj.y, self.tmx_data)  # Создаем нового врага
-                self.all_sprites.add(enemy)
-                self.enemies.add(enemy)
-            if obj.name == "Teleport":
-                self.tp = Teleport(obj.x, obj.y, self.tmx_data)
-                self.all_sprites.add(self.tp)
+                enemy_count += 1
             if obj.name == "Princess":
                 self.check = True
-                self.princess = Princess(obj.x, obj.y, self.tmx_data)
-                self.all_sprites.add(self.princess)
             if obj.name == "Shipi":
                 self.check2 = True
-                thorn = Thorn(obj.x, obj.y, self.tmx_data)
-                self.all_sprites.add(thorn)
-                self.thorns.add(thorn)
-
-
-
-        for layer in self.tmx_data.visible_layers:
-            if hasattr(layer, 'data'):
-                for x, y, gid in layer:
-                    tile = self.tmx_data.get_tile_image_by_gid(gid)
-                    if tile:
-                        tile_rect = pygame.Rect(x * self.tmx_data.tilewidth, y * self.tmx_data.tileheight,
-                                                self.tmx_data.tilewidth, self.tmx_data.tileheight)
-                        if gid != 162:
-                            self.blocked_tiles.append(tile_rect)
-                        else:
-                            self.platforms.append(tile_rect)
+            if obj.name not in self.OBJECT_NAMES:
+                continue
+            if self.stream_spawns and goals.get(obj.name) != order and (obj.name != "Enemy" or self.stream_enemies):
+                self.spawns.append((obj.x, order, number, obj, None))
+            else:
+                sprites[order] = self.create_object(obj, order, number)
+        self.spawns.sort(key=lambda spawn: spawn[:2])
+        self.Ferret = sprites[goals["Player"]]
+        self.tp = sprites[goals["Teleport"]]
+        self.teleports.add(self.tp)
+        if self.check:
+            self.princess = sprites[goals["Princess"]]
+            self.princesses.add(self.princess)
+
+        # Пакет создается сразу, даже пустым: сборка сетки тайлов посреди игры стоила бы кадров
+        self.swarm = None
+        if BATCH_ENEMIES and numpy is not None:
+            self.swarm = MobSwarm(self.enemies.sprites(), self.tmx_data)
+
+        # Взаимодействия объектов; step() опрашивает их в порядке правил игры
+        self.triggers = TriggerZones()
+        self.triggers.subscribe("princess_found", self.Ferret, self.princesses, self.on_princess_found)
+        self.triggers.subscribe("princess_rescued", self.tp, self.princesses, self.on_princess_rescued)
+        self.triggers.subscribe("thorns", self.Ferret, self.thorns, lambda hits: "death")
+        self.triggers.subscribe("enemies", self.Ferret, self.enemies, self.on_enemies)
+        self.triggers.subscribe("teleport", self.Ferret, self.teleports, self.on_teleport)
+        progress(0.6)
 
         self.camera = Camera(self.tmx_data.width * self.tmx_data.tilewidth,
                               self.tmx_data.height * self.tmx_data.tileheight)
-
-    def run(self):
-        global LEVEL_NUMBER, TOTAL_TIME
-        running = True
-
-        while running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-
-            self.current_time = time.time() - self.start_time
-
-            keys = pygame.key.get_pressed()
+        # Камера сразу смотрит на игрока: иначе на первом шаге активной считалась бы вся карта
+        self.camera.update(self.Ferret)
+        self.spawn_objects(self.activation_area())
+        progress(0.8)
+        self.map_renderer = ChunkedMapRenderer(self.tmx_data, profiler=self.profiler)
+        # Чанки вокруг игрока рисуются сразу, чтобы первый кадр уровня не ждал их
+        self.map_renderer.prefetch(self.camera.camera_rect)
+        progress(1)
+        self.previous_camera = self.camera.camera_rect.copy()
+        self.previous_positions = {}
+        self.drawn_surface = None  # Что уже выведено на экран: для частичной перерисовки
+        self.render_surface = None  # Кадр во внутреннем разрешении, если масштаб меньше 1
+        self.scaled_images = {}  # Изображение спрайта -> уменьшенная копия для текущего масштаба
+        self.drawn_camera = None
+        self.drawn_sprites = {}
+        self.replay = None  # Запись забега, в которую идут нажатия; ее задает enter()
+
+    def create_enemy(self, obj, number):
+        enemy = Mob(obj.x, obj.y, self.tmx_data)
+        # Редкие шаги дальних врагов распределяются по разным тикам
+        enemy.activation_slot = number % ENEMY_COARSE_INTERVAL
+        self.enemies.add(enemy)
+        return enemy
+
+    def create_object(self, obj, order, number, state=None):
+        """Спрайт объекта карты, добавленный в группы уровня; state - что запомнила despawn_objects."""
+        if obj.name == "Player":
+            sprite = BabyFerret(obj.x, obj.y, self.tmx_data)
+        elif obj.name == "Enemy":
+            sprite = self.create_enemy(obj, number)
+            if state is not None:
+                sprite.rect.topleft = state[:2]
+                (sprite.velocity_y, sprite.direction, sprite.frame_index, sprite.animation_timer,
+                 sprite.image) = state[2:]
+        elif obj.name == "Teleport":
+            sprite = Teleport(obj.x, obj.y, self.tmx_data)
+        elif obj.name == "Princess":
+            sprite = Princess(obj.x, obj.y, self.tmx_data)
+        else:
+            sprite = Thorn(obj.x, obj.y, self.tmx_data)
+            if state is not None:
+                sprite.rect.topleft = state
+                sprite.sleeping = True
+            else:
+                # Шип, созданный на шаге ticks, догоняет предыдущие шаги уровня, как если бы падал с загрузки
+                sprite.catch_up(max(0, self.ticks - 1), self.blocked_tiles,
+                                self.tmx_data.height * self.tmx_data.tileheight)
+            sprite.awake_group = self.awake_thorns
+            self.thorns.add(sprite)
+            if not sprite.sleeping:
+                self.awake_thorns.add(sprite)
+        sprite.spawn_order = order
+        sprite.spawn = (number, obj)
+        self.all_sprites.add(sprite)
+        return sprite
+
+    def activation_area(self):
+        """Область вокруг камеры, в которой враги симулируются полностью."""
+        return self.camera.camera_rect.inflate(2 * ENEMY_ACTIVATION_MARGIN, 2 * ENEMY_ACTIVATION_MARGIN)
+
+    def spawn_objects(self, area):
+        """Создание объектов, чье место (точка появления или место выгрузки) по горизонтали попало в area."""
+        if not self.spawns:
+            return
+        first = bisect.bisect_left(self.spawns, (area.left - ENEMY_SIZE,))
+        last = bisect.bisect_left(self.spawns, (area.right,))
+        sprites = []
+        waiting = []
+        for spawn in self.spawns[first:last]:
+            x, order, number, obj, state = spawn
+            # Все объекты карты шириной в кадр слайма
+            if x + ENEMY_SIZE > area.left:
+                sprites.append(self.create_object(obj, order, number, state))
+            else:
+                waiting.append(spawn)
+        if not sprites:
+            return
+        self.spawns[first:last] = waiting
+        enemies = [sprite for sprite in sprites if isinstance(sprite, Mob)]
+        if self.swarm is not None and enemies:
+            self.swarm.add(enemies)
+        # Порядок групп как при создании всех объектов сразу: от него зависят отрисовка и столкновения
+        for group in (self.all_sprites, self.enemies, self.thorns):
+            sprites = sorted(group.sprites(), key=lambda sprite: sprite.spawn_order)
+            group.empty()
+            group.add(*sprites)
+
+    def despawn_objects(self, area):
+        """Возврат в self.spawns объектов, ушедших по горизонтали дальше DESPAWN_MARGIN от области area,
+        если без камеры они все равно не изменятся: замороженных врагов, уснувших шипов и украшений."""
+        left = area.left - DESPAWN_MARGIN
+        right = area.right + DESPAWN_MARGIN
+        goals = (self.Ferret, self.tp, self.princess if self.check else None)
+        removed = []
+        for sprite in self.all_sprites:
+            if left < sprite.rect.right and sprite.rect.left < right or sprite in goals:
+                continue
+            number, obj = sprite.spawn
+            if isinstance(sprite, Mob):
+                if sprite.is_dead or not self.stream_enemies:
+                    continue
+                state = (sprite.rect.x, sprite.rect.y, sprite.velocity_y, sprite.direction, sprite.frame_index,
+                         sprite.animation_timer, sprite.image)
+            elif isinstance(sprite, Thorn):
+                if not sprite.sleeping:
+                    continue
+                state = sprite.rect.topleft
+            else:
+                state = None
+            removed.append(sprite)
+            bisect.insort(self.spawns, (sprite.rect.x, sprite.spawn_order, number, obj, state))
+        if not removed:
+            return
+        enemies = [sprite for sprite in removed if isinstance(sprite, Mob)]
+        if self.swarm is not None and enemies:
+            self.swarm.remove(enemies)
+        for sprite in removed:
+            sprite.kill()
+
+    def step(self, keys):
+        """Один шаг симуляции фиксированной длины. Возвращает исход: None, "death", "next" или "win"."""
+        self.ticks += 1
+        self.current_time = self.ticks / TICK_RATE
+        # Полностью симулируются только враги рядом с камерой (и умирающие, чтобы доиграть анимацию)
+        active_area = self.activation_area()
+        if self.stream_spawns and self.ticks % DESPAWN_INTERVAL == 0:
+            self.despawn_objects(active_area)
+        self.spawn_objects(active_area)
+        # Положения до шага нужны для интерполяции при отрисовке. Запоминаются только спрайты, которые
+        # могут сдвинуться на этом шаге; остальные рисуются на своем месте
+        self.previous_camera = self.camera.camera_rect.copy()
+        previous = self.previous_positions = {self.Ferret: self.Ferret.rect.copy()}
+
+        profiler = self.profiler
+
+        coarse = ENEMY_INACTIVE_MODE == "coarse"
+        if self.swarm is not None:
+            steps = self.swarm.steps(active_area, coarse, self.ticks)
+            moved = [self.swarm.mobs[index] for index in numpy.flatnonzero(steps).tolist()]
+            for enemy in moved:
+                previous[enemy] = enemy.rect.copy()
+            self.swarm.update(steps)
+        else:
+            moved = []
+            steps = []
             for enemy in self.enemies:
-                enemy.update(keys, self.platforms, self.blocked_tiles)
-
+                if enemy.is_dead or active_area.colliderect(enemy.rect):
+                    moved.append(enemy)
+                    steps.append(1)
+                elif coarse and (self.ticks + enemy.activation_slot) % ENEMY_COARSE_INTERVAL == 0:
+                    # Дальний враг проходит сразу весь интервал с прошлого грубого шага
+                    moved.append(enemy)
+                    steps.append(ENEMY_COARSE_INTERVAL)
+            for enemy, ticks in zip(moved, steps):
+                previous[enemy] = enemy.rect.copy()
+                enemy.update(keys, self.platforms, self.blocked_tiles, ticks)
+        self.enemies.relocate(moved)
+        profiler.mark("enemies")
+
+        for body in [self.tp] + ([self.princess] if self.check else []) + self.awake_thorns.sprites():
+            if not body.sleeping:
+                previous[body] = body.rect.copy()
+
+        if not self.tp.sleeping:
             self.tp.update(keys, self.platforms, self.blocked_tiles)
+            self.teleports.relocate([self.tp])
+        profiler.mark("objects")
 
-            self.Ferret.update(keys, self.platforms, self.blocked_tiles)
+        self.Ferret.update(keys, self.platforms, self.blocked_tiles)
+        profiler.mark("ferret")
 
-            if self.check:
+        if self.check:
+            if not self.princess.sleeping:
                 self.princess.update(keys, self.platforms, self.blocked_tiles)
-                if pygame.sprite.collide_rect(self.Ferret, self.princess):
-                    self.princess.run()
-
-                if pygame.sprite.collide_rect(self.tp, self.princess):
-                    self.princess.kill()
-                    self.check_win = True
-
-            if self.check2:
-                self.thorns.update(keys, self.platforms, self.blocked_tiles)
-                hits = pygame.sprite.spritecollide(self.Ferret, self.thorns, False)
-                if hits:
-                    LEVEL_NUMBER = 0
-                    DeathScreen().run()
-                    return
-
-            self.camera.update(self.Ferret)
-
-            hits = pygame.sprite.spritecollide(self.Ferret, self.enemies, False)
-            for slime in hits:
-                if self.Ferret.velocity_y > 0 and self.Ferret.rect.bottom <= slime.rect.top + 1000:
-                    slime.die()
-                    self.Ferret.velocity_y = JUMP_STRENGTH // 2
-                else:
-                    if self.Ferret.on_ground:
-                        LEVEL_NUMBER = 0
-                        DeathScreen().run()
-                        return
-
-            if pygame.sprite.collide_rect(self.Ferret, self.tp) and not self.check:
+                self.princesses.relocate([self.princess])
+            profiler.mark("objects")
+            self.triggers.fire("princess_found")
+            self.triggers.fire("princess_rescued")
+            profiler.mark("collisions")
+
+        if self.check2:
+            # Уснувшие на этом шаге шипы уходят из awake_thorns, но их последний сдвиг тоже учитывается
+            falling = self.awake_thorns.sprites()
+            self.awake_thorns.update(keys, self.platforms, self.blocked_tiles)
+            self.thorns.relocate(falling)
+            profiler.mark("objects")
+        # Сдвинуться за шаг могли только запомненные спрайты
+        self.all_sprites.relocate(previous)
+        if self.check2:
+            if self.triggers.fire("thorns"):
+                return "death"
+            profiler.mark("collisions")
+
+        self.camera.update(self.Ferret)
+        profiler.mark("camera")
+
+        if self.triggers.fire("enemies"):
+            return "death"
+        outcome = self.triggers.fire("teleport")
+        profiler.mark("collisions")
+        return outcome
+
+    def on_princess_found(self, hits):
+        self.princess.run()
+
+    def on_princess_rescued(self, hits):
+        self.princess.kill()
+        self.check_win = True
+
+    def on_enemies(self, hits):
+        """Прыжок сверху убивает врага и подбрасывает хорька; касание на земле - смерть."""
+        for slime in hits:
+            if self.Ferret.velocity_y > 0 and self.Ferret.rect.bottom <= slime.rect.top + 1000:
+                slime.die()
+                self.Ferret.velocity_y = JUMP_STRENGTH // 2
+            else:
+                if self.Ferret.on_ground:
+                    return "death"
+        return None
+
+    def on_teleport(self, hits):
+        if not self.check:
+            return "next"
+        if self.check_win:
+            return "win"
+        return None
+
+    def enter(self):
+        global current_replay
+        # Следующий уровень грузится в фоне, пока идет текущий
+        if LEVEL_NUMBER + 1 < len(LEVELS):
+            preload_level(LEVELS[LEVEL_NUMBER + 1])
+        if current_replay is None:
+            current_replay = Replay.start()
+        self.replay = current_replay
+        self.replay.start_level(self.map_file)
+
+    def update(self, dt):
+        global LEVEL_NUMBER, TOTAL_TIME, current_replay
+        # Симуляция идет шагами фиксированной длины независимо от частоты кадров
+        tick = 1 / TICK_RATE
+        self.accumulator += min(dt, MAX_TICKS_PER_FRAME * tick)
+
+        keys = KeyState.from_pressed(pygame.key.get_pressed())
+        outcome = None
+        while self.accumulator >= tick and outcome is None:
+            outcome = self.step(keys)
+            self.replay.record(keys.mask)
+            self.accumulator -= tick
+        self.alpha = self.accumulator / tick if INTERPOLATE_RENDERING else 1
+
+        if outcome == "death":
+            LEVEL_NUMBER = 0
+            self.manager.switch(DeathScreen())
+        elif outcome is not None:
+            TOTAL_TIME += self.current_time
+            if outcome == "next":
                 LEVEL_NUMBER += 1
-                if LEVEL_NUMBER < len(LEVELS):
-                    TOTAL_TIME += self.current_time
-                    DownloadScreen().loading_screen()
-                    level = Level(LEVELS[LEVEL_NUMBER])
-                    level.run()
-                    return
-                else:
-                    TOTAL_TIME += self.current_time
-                    record_screen = RecordScreen()
-                    record_screen.add_record(TOTAL_TIME)
-                    win_screen = WinScreen(TOTAL_TIME)
-                    LEVEL_NUMBER = 0
-                    TOTAL_TIME = 0
-                    win_screen.run()
-                    return
+            if outcome == "next" and LEVEL_NUMBER < len(LEVELS):
+                self.manager.switch(DownloadScreen(LEVELS[LEVEL_NUMBER]))
             else:
-                if self.check_win and pygame.sprite.collide_rect(self.Ferret, self.tp):
-                    TOTAL_TIME += self.current_time
-                    record_screen = RecordScreen()
-                    record_screen.add_record(TOTAL_TIME)
-                    win_screen = WinScreen(TOTAL_TIME)
-                    LEVEL_NUMBER = 0
-                    TOTAL_TIME = 0
-                    win_screen.run()
-                    return
+                get_records_service().add_record(TOTAL_TIME, self.replay)
+                self.manager.switch(WinScreen(TOTAL_TIME))
+                LEVEL_NUMBER = 0
+                TOTAL_TIME = 0
+                current_replay = None
+
+    def draw(self, surface=None, alpha=None):
+        """Отрисовка кадра между двумя последними шагами симуляции (alpha от 0 до 1).
+
+        Если камера стоит на месте, перерисовываются только области спрайтов, сдвинувшихся
+        или сменивших кадр, и возвращается их список; иначе кадр рисуется целиком (None).
+        При масштабе внутреннего разрешения меньше 1 кадр всегда рисуется целиком."""
+        surface = surface or screen
+        alpha = self.alpha if alpha is None else alpha
+        camera_rect = interpolate_rect(self.previous_camera, self.camera.camera_rect, alpha)
+        placed = {}  # Спрайт -> (прямоугольник на экране, изображение)
+        for sprite in self.visible_sprites(camera_rect):
+            rect = interpolate_rect(self.previous_positions.get(sprite, sprite.rect), sprite.rect, alpha)
+            placed[sprite] = (rect.move(-camera_rect.x, -camera_rect.y), sprite.image)
+
+        scale = render_governor.scale
+        partial = (DIRTY_RENDERING and not self.dirty and surface is self.drawn_surface
+                   and camera_rect == self.drawn_camera and scale == 1)
+        if scale != 1:
+            self.draw_scaled(surface, camera_rect, placed, scale)
+            dirty_rects = None
+        elif partial:
+            dirty_rects = self.redraw_changed(surface, camera_rect, placed)
+        else:
+            surface.fill(CYAN)
+            self.map_renderer.draw(surface, camera_rect)
+            self.profiler.mark("render_map")
+            for rect, image in placed.values():
+                surface.blit(image, rect)
+            self.profiler.mark("sprites")
+            dirty_rects = None
+        self.map_renderer.prefetch(camera_rect)
+        self.profiler.mark("render_map")
+        self.dirty = False
+        self.drawn_surface = surface if scale == 1 else None
+        self.drawn_camera = camera_rect
+        self.drawn_sprites = placed
+        return dirty_rects
+
+    def visible_sprites(self, camera_rect):
+        """Спрайты, которые могут попасть в кадр, в порядке отрисовки. Не сдвинувшиеся на последнем шаге
+        стоят там же, где и рисуются, и отбираются по хешу; сдвинувшиеся добавляются все, потому что
+        их промежуточное положение может быть в кадре, даже если текущее уже вне его."""
+        sprites = set(self.all_sprites.collide(camera_rect))
+        sprites.update(sprite for sprite in self.previous_positions if sprite in self.all_sprites)
+        return sorted(sprites, key=self.all_sprites.order)
+
+    def draw_scaled(self, surface, camera_rect, placed, scale):
+        """Мир рисуется на поверхность внутреннего разрешения и растягивается на весь surface."""
+        size = (round(surface.get_width() * scale), round(surface.get_height() * scale))
+        if self.render_surface is None or self.render_surface.get_size() != size:
+            self.render_surface = pygame.Surface(size).convert(surface)
+            self.scaled_images = {}
+            self.profiler.count_surface()
+        target = self.render_surface
+        target.fill(CYAN)
+        self.map_renderer.draw(target, camera_rect, scale)
+        self.profiler.mark("render_map")
+        for rect, image in placed.values():
+            scaled = self.scaled_images.get(image)
+            if scaled is None:
+                scaled = self.scaled_images[image] = pygame.transform.scale(
+                    image, (round(image.get_width() * scale), round(image.get_height() * scale)))
+                self.profiler.count_surface()
+            target.blit(scaled, (round(rect.x * scale), round(rect.y * scale)))
+        self.profiler.mark("sprites")
+        pygame.transform.scale(target, surface.get_size(), surface)
+        self.profiler.mark("upscale")
+
+    def redraw_changed(self, surface, camera_rect, placed):
+        """Перерисовка фона и спрайтов в старых и новых областях изменившихся спрайтов."""
+        areas = []
+        for sprite, (rect, image) in self.drawn_sprites.items():
+            if placed.get(sprite) != (rect, image):
+                areas.append(rect.union(placed[sprite][0]) if sprite in placed else rect)
+        for sprite, (rect, image) in placed.items():
+            if sprite not in self.drawn_sprites:
+                areas.append(rect)
+        # Пересекающиеся области сливаются, чтобы ни один пиксель не рисовался дважды
+        merged = []
+        for area in areas:
+            area = area.clip(surface.get_rect())
+            index = area.collidelist(merged)
+            while index != -1:
+                area = area.union(merged.pop(index))
+                index = area.collidelist(merged)
+            if area.width and area.height:
+                merged.append(area)
+
+        clip = surface.get_clip()
+        for area in merged:
+            surface.set_clip(area)
+            surface.fill(CYAN, area)
+            self.map_renderer.draw(surface, camera_rect)
+        self.profiler.mark("render_map")
+        for area in merged:
+            surface.set_clip(area)
+            for rect, image in placed.values():
+                if area.colliderect(rect):
+                    surface.blit(image, rect)
+        surface.set_clip(clip)
+        self.profiler.mark("sprites")
+        return merged
+
+    def close(self):
+        """Освобождение ресурсов уровня при уходе с него."""
+        self.tmx_data.close()
+        for group in (self.all_sprites, self.enemies, self.thorns, self.awake_thorns, self.teleports,
+                      self.princesses):
+            group.empty()
+        self.triggers.clear()
+        self.spawns = []
+        self.swarm = None
+        self.previous_positions = {}
+        self.drawn_sprites = {}
+        self.render_surface = None
+        self.scaled_images = {}
+        self.map_renderer = None
+
+    def render_map(self, camera_rect=None):
+        self.map_renderer.draw(screen, camera_rect or self.camera.camera_rect)
+
+
+class LevelLoader:
+    """Загрузка уровня в фоновом потоке с отчетом о прогрессе."""
 
-
-            screen.fill(CYAN)
-            self.render_map()
-            for sprite in self.all_sprites:
-                screen.blit(sprite.image, self.camera.apply(sprite.rect))
-
-            pygame.display.flip()
-            clock.tick(FPS)
-
-    def render_map(self):
-        for layer in self.tmx_data.visible_layers:
-            if hasattr(layer, 'data'):
-                for x, y, gid in layer:
-                    tile = self.tmx_data.get_tile_image_by_gid(gid)
-                    if tile:
-                        screen.blit(tile, (x * self.tmx_data.tilewidth - self.camera.camera_rect.x,
-                                           y * self.tmx_data.tileheight - self.camera.camera_rect.y))
+    def __init__(self, map_file):
+        self.map_file = map_file
+        self.progress = 0
+        self.level = None
+        self.error = None
+        self.thread = threading.Thread(target=self.load, daemon=True)
+        self.thread.start()
+
+    def load(self):
+        try:
+            self.level = Level(self.map_file, progress=self.set_progress)
+        except Exception as error:
+            self.error = error
+        self.progress = 1
+
+    def set_progress(self, value):
+        self.progress = value
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.level
+
+
+preloaded_levels = {}  # Файл карты -> LevelLoader с уровнем, который еще не запускался
+
+
+def preload_level(map_file):
+    """Запуск фоновой загрузки уровня, если она еще не идет."""
+    if map_file not in preloaded_levels:
+        preloaded_levels[map_file] = LevelLoader(map_file)
+    return preloaded_levels[map_file]
+
+
+def take_level_loader(map_file):
+    """Загрузчик уровня для запуска; каждый загруженный уровень выдается только один раз."""
+    return preloaded_levels.pop(map_file, None) or LevelLoader(map_file)
+
+
+class Replay:
+    """Запись забега: сид случайных чисел, частота шагов и маски клавиш каждого шага
+    для каждой попытки уровня по порядку, включая попытки, закончившиеся смертью."""
+
+    MAGIC = b"SMHRPL"
+    HEADER = struct.Struct("<6sHHIH")  # сигнатура, версия формата, частота шагов, сид, число попыток
+    LEVEL = struct.Struct("<HI")  # длина имени карты в байтах, число серий одинаковых масок
+    RUN = struct.Struct("<BH")  # маска клавиш, сколько шагов подряд она держалась
+    VERSION = 1
+
+    def __init__(self, seed, tick_rate=TICK_RATE, levels=None):
+        self.seed = seed
+        self.tick_rate = tick_rate
+        self.levels = levels or []  # [(файл карты, array('B') масок по шагам)]
+
+    @classmethod
+    def start(cls):
+        """Новая запись; случайные числа игры с этого момента идут от сохраненного сида."""
+        seed = random.randrange(2 ** 32)
+        random.seed(seed)
+        return cls(seed)
+
+    def start_level(self, map_file):
+        self.levels.append((map_file, array('B')))
+
+    def record(self, mask):
+        self.levels[-1][1].append(mask)
+
+    def to_bytes(self):
+        parts = [self.HEADER.pack(self.MAGIC, self.VERSION, self.tick_rate, self.seed, len(self.levels))]
+        for map_file, inputs in self.levels:
+            # Клавиши держат подолгу, поэтому маски хранятся сериями
+            runs = []
+            for mask in inputs:
+                if runs and runs[-1][0] == mask and runs[-1][1] < 0xFFFF:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([mask, 1])
+            name = map_file.encode("utf-8")
+            parts.append(self.LEVEL.pack(len(name), len(runs)))
+            parts.append(name)
+            parts.extend(self.RUN.pack(mask, length) for mask, length in runs)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, tick_rate, seed, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("не файл повтора или неизвестная версия формата")
+        offset = cls.HEADER.size
+        levels = []
+        for _ in range(count):
+            name_length, run_count = cls.LEVEL.unpack_from(data, offset)
+            offset += cls.LEVEL.size
+            map_file = data[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            inputs = array('B')
+            for mask, length in cls.RUN.iter_unpack(data[offset:offset + run_count * cls.RUN.size]):
+                inputs.extend([mask] * length)
+            offset += run_count * cls.RUN.size
+            levels.append((map_file, inputs))
+        return cls(seed, tick_rate, levels)
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            return cls.from_bytes(file.read())
+
+
+def simulate_replay(replay):
+    """Повтор забега без окна и ожидания кадров по тем же правилам переходов между уровнями, что в игре.
+
+    Возвращает список попыток (файл карты, исход, шагов) и время забега; время None, если забег
+    не дошел до победы или запись не сходится с игрой (другая частота шагов, не тот уровень,
+    лишние или недостающие шаги)."""
+    if replay.tick_rate != TICK_RATE:
+        return [], None
+    random.seed(replay.seed)
+    attempts = []
+    level_number = 0
+    total_time = 0
+    for index, (map_file, inputs) in enumerate(replay.levels):
+        if level_number >= len(LEVELS) or map_file != LEVELS[level_number]:
+            return attempts, None
+        level = Level(map_file)
+        outcome = None
+        for mask in inputs:
+            outcome = level.step(KeyState(mask))
+            if outcome is not None:
+                break
+        level.close()
+        attempts.append((map_file, outcome, level.ticks))
+        if outcome is None or level.ticks != len(inputs):
+            return attempts, None
+        if outcome == "death":
+            level_number = 0
+            continue
+        total_time += level.current_time
+        if outcome == "next":
+            level_number += 1
+        if outcome == "win" or level_number == len(LEVELS):
+            # После победы отсчет начинается заново, так что попытка должна быть последней
+            return attempts, total_time if index == len(replay.levels) - 1 else None
+    return attempts, None
+
+
+def verify_replay(replay, claimed_time, tolerance=1e-6):
+    """Совпадает ли заявленное время забега со временем, полученным повтором записи."""
+    simulated_time = simulate_replay(replay)[1]
+    return simulated_time is not None and abs(simulated_time - claimed_time) <= tolerance
 
 
 class Button:
@@ -464,8 +2489,7 @@ class Button:
         self.rect = pygame.Rect(x, y, width, height)
         self.color = GRAY
         self.text = text
-        self.font = pygame.font.Font(None, font_size)
-        self.text_surf = self.font.render(text, True, BLACK)
+        self.text_surf = text_cache.render(text, font_size)
 
     def draw(self, screen):
         pygame.draw.rect(screen, self.color, self.rect)
@@ -476,210 +2500,255 @@ class Button:
         return self.rect.collidepoint(pos)
 
 
-class StartScreen:
+class StartScreen(MenuScene):
     def __init__(self):
-        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
-        self.font = pygame.font.Font(None, 74)
-        self.text = self.font.render("Супер Малыш Хорек", True, BLACK)
+        self.background = assets.image("pictures/Main_menu.jpg", alpha=False, group="ui")
+        self.text = text_cache.render("Супер Малыш Хорек", 74)
         self.start_button = Button(WIDTH // 2 - 100, HEIGHT // 2 - 50, 200, 50, "Начать игру")
         self.scores_button = Button(WIDTH // 2 - 100, HEIGHT // 2 + 50, 200, 50, "Рекорды")
         self.exit_button = Button(WIDTH // 2 - 100, HEIGHT // 2 + 150, 200, 50, "Выход")
         self.buttons = [self.start_button, self.scores_button, self.exit_button]
 
-    def run(self):
-        while True:
-            bg = pygame.image.load("pictures/Main_menu.jpg")
-            self.screen.blit(bg, (0, 0))
-            self.screen.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4))
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1:
-                        for button in self.buttons:
-                            if button.is_clicked(event.pos):
-                                if button.text == "Начать игру":
-                                    DownloadScreen().loading_screen()
-                                    level = Level("maps/FirstLevel.tmx")
-                                    level.run()
-                                    return
-                                elif button.text == "Рекорды":
-                                    RecordScreen().run()
-                                    return
-                                elif button.text == "Выход":
-                                    pygame.quit()
-                                    sys.exit()
-
-            for button in self.buttons:
-                button.draw(self.screen)
-
-            pygame.display.flip()
-            clock.tick(FPS)
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 1:
+                for button in self.buttons:
+                    if button.is_clicked(event.pos):
+                        if button.text == "Начать игру":
+                            self.manager.switch(DownloadScreen(LEVELS[0]))
+                        elif button.text == "Рекорды":
+                            self.manager.switch(RecordScreen())
+                        elif button.text == "Выход":
+                            self.manager.quit()
+                        return
 
+    def render(self, surface):
+        surface.blit(self.background, (0, 0))
+        surface.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4))
+        for button in self.buttons:
+            button.draw(surface)
 
-class RecordScreen:
-    def __init__(self, db_path="records.db"):
-        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
-        self.font = pygame.font.Font(None, 48)
-        self.title_font = pygame.font.Font(None, 74)
-        self.db_path = db_path
-        self.exit_button = Button(WIDTH // 2 - 100, HEIGHT - 100, 200, 50, "Назад")
-        self.initialize_db()
-        self.records = self.get_top_records()
 
-    def initialize_db(self):
-        # Создаем таблицу, если ее нет
-        connection = sqlite3.connect(self.db_path)
+class RecordsService:
+    """Таблица рекордов: одно соединение в режиме WAL, запись в фоновом потоке и кэш лучших времен.
+
+    Базу открывает и схему создает тот же фоновый поток, поэтому ни создание сервиса, ни запись
+    рекорда не ждут диска в кадре игры; чтение ждет, пока база будет открыта."""
+
+    def __init__(self, db_path=RECORDS_DB):
+        self.db_path = db_path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()  # Фоновый поток открыл базу (или не смог)
+        self.top_records = {}  # limit -> лучшие времена из базы, сбрасывается при записи
+        self.pending = []  # Времена, поставленные в очередь, но еще не записанные
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def open(self):
+        connection = sqlite3.connect(self.db_path, check_same_thread=False)
         cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS records (
                 id INTEGER PRIMARY KEY,
                 time REAL
             )
         ''')
+        # Индекс превращает ORDER BY time LIMIT N в чтение первых N записей индекса
+        cursor.execute('CREATE INDEX IF NOT EXISTS records_time ON records (time)')
+        # Повторы лежат отдельно, чтобы чтение таблицы рекордов не тянуло их с диска
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS replays (
+                record_id INTEGER PRIMARY KEY REFERENCES records (id),
+                data BLOB NOT NULL
+            )
+        ''')
         connection.commit()
-        connection.close()
-
-    def get_top_records(self):
-        # Подключение к базе данных и получение 5 лучших времен
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        cursor.execute('SELECT time FROM records ORDER BY time ASC LIMIT 5')
-        records = cursor.fetchall()
-        connection.close()
+        self.connection = connection
+
+    def database(self):
+        """Соединение с базой, как только фоновый поток ее откроет."""
+        self.ready.wait()
+        if self.connection is None:
+            raise sqlite3.OperationalError("не удалось открыть базу рекордов {0}".format(self.db_path))
+        return self.connection
+
+    def add_record(self, time, replay=None):
+        """Запись нового времени (и повтора забега) без ожидания базы: повтор кодирует и вставку
+        выполняет фоновый поток."""
+        with self.lock:
+            self.pending.append(time)
+        self.queue.put((time, replay))
+
+    def write_loop(self):
+        try:
+            self.open()
+        finally:
+            self.ready.set()
+        while True:
+            batch = [self.queue.get()]
+            # Все, что накопилось в очереди, записывается одной транзакцией
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            # Повтор кодируется здесь, а не в кадре, в котором закончился забег
+            records = [(time, replay.to_bytes() if replay is not None else None) for time, replay in records]
+            if records:
+                with self.lock:
+                    for time, replay in records:
+                        cursor = self.connection.execute('INSERT INTO records (time) VALUES (?)', (time,))
+                        if replay is not None:
+                            self.connection.execute('INSERT INTO replays (record_id, data) VALUES (?, ?)',
+                                                    (cursor.lastrowid, replay))
+                    self.connection.commit()
+                    for time, _ in records:
+                        self.pending.remove(time)
+                    self.top_records.clear()
+            for _ in batch:
+                self.queue.task_done()
+            if None in batch:
+                return
+
+    def get_top_records(self, limit=LEADERBOARD_SIZE):
+        connection = self.database()
+        with self.lock:
+            records = self.top_records.get(limit)
+            if records is None:
+                cursor = connection.execute('SELECT time FROM records ORDER BY time ASC LIMIT ?', (limit,))
+                records = self.top_records[limit] = cursor.fetchall()
+            if self.pending:
+                records = sorted(records + [(time,) for time in self.pending])[:limit]
         return records
 
-    def add_record(self, time):
-        # Добавление нового рекорда
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        cursor.execute('INSERT INTO records (time) VALUES (?)', (time,))
-        connection.commit()
-        connection.close()
+    def get_replays(self):
+        """Все рекорды, у которых есть повтор: (id, время, Replay)."""
+        connection = self.database()
+        with self.lock:
+            rows = connection.execute('SELECT records.id, records.time, replays.data FROM records '
+                                      'JOIN replays ON replays.record_id = records.id '
+                                      'ORDER BY records.time').fetchall()
+        return [(record_id, time, Replay.from_bytes(data)) for record_id, time, data in rows]
 
-    def run(self):
-        running = True
-        while running:
-            self.screen.fill(WHITE)
-
-            # Заголовок экрана рекордов
-            title_surface = self.title_font.render("Таблица Рекордов", True, BLACK)
-            self.screen.blit(title_surface, (WIDTH // 2 - title_surface.get_width() // 2, 50))
-
-            # Отображение рекордов
-            for index, record in enumerate(self.records):
-                record_text = f"{index + 1}. {record[0]:.2f} сек"
-                record_surface = self.font.render(record_text, True, BLACK)
-                self.screen.blit(record_surface, (WIDTH // 2 - record_surface.get_width() // 2, 150 + index * 50))
-
-            # Отображение кнопки выхода
-            self.exit_button.draw(self.screen)
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1 and self.exit_button.is_clicked(event.pos):
-                        StartScreen().run()
-                        return
+    def flush(self):
+        self.queue.join()
 
-            pygame.display.flip()
-            clock.tick(FPS)
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        if self.connection is not None:
+            self.connection.close()
 
 
-class WinScreen:
+records_service = None
+
+
+def get_records_service():
+    global records_service
+    if records_service is None:
+        records_service = RecordsService()
+    return records_service
+
+
+class RecordScreen(MenuScene):
+    def __init__(self, records=None):
+        self.exit_button = Button(WIDTH // 2 - 100, HEIGHT - 100, 200, 50, "Назад")
+        self.records = (records or get_records_service()).get_top_records()
+
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 1 and self.exit_button.is_clicked(event.pos):
+                self.manager.switch(StartScreen())
+
+    def render(self, surface):
+        surface.fill(WHITE)
+
+        # Заголовок экрана рекордов
+        title_surface = text_cache.render("Таблица Рекордов", 74)
+        surface.blit(title_surface, (WIDTH // 2 - title_surface.get_width() // 2, 50))
+
+        # Отображение рекордов
+        for index, record in enumerate(self.records):
+            record_text = f"{index + 1}. {record[0]:.2f} сек"
+            record_surface = text_cache.render(record_text, 48)
+            surface.blit(record_surface, (WIDTH // 2 - record_surface.get_width() // 2, 150 + index * 50))
+
+        # Отображение кнопки выхода
+        self.exit_button.draw(surface)
+
+
+class WinScreen(MenuScene):
     def __init__(self, time):
         self.time = time
-        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
-        self.font = pygame.font.Font(None, 65)
-        self.text = self.font.render(f"Время: {self.time:.2f} сек", True, BLACK)
+        self.background = assets.image("pictures/WinScreen.jpg", alpha=False, group="ui")
+        self.text = text_cache.render(f"Время: {self.time:.2f} сек", 65)
         self.start_button = Button(WIDTH // 2 - 100, HEIGHT // 2 - 50, 200, 50, "Главное меню")
         self.scores_button = Button(WIDTH // 2 - 100, HEIGHT // 2 + 50, 200, 50, "Рекорды")
         self.exit_button = Button(WIDTH // 2 - 100, HEIGHT // 2 + 150, 200, 50, "Выход")
         self.buttons = [self.start_button, self.scores_button, self.exit_button]
 
-    def run(self):
-        while True:
-            bg = pygame.image.load("pictures/WinScreen.jpg")
-            self.screen.blit(bg, (0, 0))
-            self.screen.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4 + 50))
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1:
-                        for button in self.buttons:
-                            if button.is_clicked(event.pos):
-                                if button.text == "Главное меню":
-                                    DownloadScreen().loading_screen()
-                                    StartScreen().run()
-                                    return
-
-                                elif button.text == "Рекорды":
-                                    RecordScreen().run()
-                                    return
-
-                                elif button.text == "Выход":
-                                    pygame.quit()
-                                    sys.exit()
-
-            for button in self.buttons:
-                button.draw(self.screen)
-
-            pygame.display.flip()
-            clock.tick(FPS)
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 1:
+                for button in self.buttons:
+                    if button.is_clicked(event.pos):
+                        if button.text == "Главное меню":
+                            # Пока игрок в меню, первый уровень уже будет готов
+                            self.manager.switch(DownloadScreen(LEVELS[0], next_scene=StartScreen))
+                        elif button.text == "Рекорды":
+                            self.manager.switch(RecordScreen())
+                        elif button.text == "Выход":
+                            self.manager.quit()
+                        return
+
+    def render(self, surface):
+        surface.blit(self.background, (0, 0))
+        surface.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4 + 50))
+        for button in self.buttons:
+            button.draw(surface)
 
 
-class DeathScreen:
+class DeathScreen(MenuScene):
     def __init__(self):
-        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
-        self.font = pygame.font.Font(None, 74)
-        self.text = self.font.render("", True, BLACK)
+        self.background = assets.image("pictures/Die_screen.jpg", alpha=False, group="ui")
+        self.text = text_cache.render("", 74)
         self.start_button = Button(WIDTH // 2 - 100, HEIGHT // 2 - 50, 200, 50, "Главное меню")
         self.exit_button = Button(WIDTH // 2 - 100, HEIGHT // 2 + 50, 200, 50, "Выход")
         self.buttons = [self.start_button, self.exit_button]
 
-    def run(self):
-        while True:
-            bg = pygame.image.load("pictures/Die_screen.jpg")
-            self.screen.blit(bg, (0, 0))
-            self.screen.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4))
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1:
-                        for button in self.buttons:
-                            if button.is_clicked(event.pos):
-                                if button.text == "Главное меню":
-                                    DownloadScreen().loading_screen()
-                                    StartScreen().run()
-                                    return
-
-                                elif button.text == "Выход":
-                                    pygame.quit()
-                                    sys.exit()
-
-            for button in self.buttons:
-                button.draw(self.screen)
-
-            pygame.display.flip()
-            clock.tick(FPS)
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 1:
+                for button in self.buttons:
+                    if button.is_clicked(event.pos):
+                        if button.text == "Главное меню":
+                            # Пока игрок в меню, первый уровень уже будет готов
+                            self.manager.switch(DownloadScreen(LEVELS[0], next_scene=StartScreen))
+                        elif button.text == "Выход":
+                            self.manager.quit()
+                        return
 
+    def render(self, surface):
+        surface.blit(self.background, (0, 0))
+        surface.blit(self.text, (WIDTH // 2 - self.text.get_width() // 2, HEIGHT // 4))
+        for button in self.buttons:
+            button.draw(surface)
 
-class DownloadScreen:
-    def __init__(self):
-        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
-        self.clock = pygame.time.Clock()
-        self.font = pygame.font.Font(None, 74)
-        self.small_font = pygame.font.Font(None, 36)
+
+class DownloadScreen(Scene):
+    """Экран загрузки, пока уровень грузится в фоне. Затем открывается загруженный уровень,
+    либо сцена next_scene, а уровень остается готовым в очереди предзагрузки."""
+
+    def __init__(self, map_file, next_scene=None, min_duration=LOADING_MIN_DURATION):
+        self.map_file = map_file
+        self.next_scene = next_scene
+        self.min_duration = min_duration
+        self.loader = None
         self.offers = [
             'А вы знаете, что очень трудно найти спрайт хорька?',
             'Хорек обнаружил неинициализированную переменную. Он ее унес.',
@@ -701,37 +2770,56 @@ class DownloadScreen:
         self.additional_text = random.choice(self.offers)
         self.dots = ["", ".", "..", "..."]
         self.current_dot_index = 0
-        self.last_update = pygame.time.get_ticks()
-        self.dot_animation_speed = 300
-
-    def draw_loading_screen(self):
-        self.screen.fill(WHITE)
-        loading_surface = self.font.render(self.loading_text + self.dots[self.current_dot_index], True, BLACK)
-        self.screen.blit(loading_surface, (WIDTH // 2 - loading_surface.get_width() // 2, HEIGHT // 2 - 50))
+        self.last_update = time.perf_counter()
+        self.dot_animation_speed = 0.3  # Секунд на шаг анимации точек
+        self.drawn_state = None
+
+    def enter(self):
+        if self.next_scene is None:
+            self.loader = take_level_loader(self.map_file)
+        else:
+            self.loader = preload_level(self.map_file)
+        self.start_time = time.time()
+
+    def update(self, dt):
+        now = time.perf_counter()
+        if now - self.last_update > self.dot_animation_speed:
+            self.current_dot_index = (self.current_dot_index + 1) % len(self.dots)
+            self.last_update = now
+
+        if self.loader.done() and time.time() - self.start_time >= self.min_duration:
+            if self.next_scene is None:
+                self.manager.switch(self.loader.result())
+            else:
+                self.manager.switch(self.next_scene())
 
-        additional_surface = self.small_font.render(self.additional_text, True, BLACK)
-        self.screen.blit(additional_surface, (WIDTH // 2 - additional_surface.get_width() // 2, HEIGHT // 2 + 50))
-        pygame.display.flip()
+    def draw(self, surface):
+        # Экран меняется только вместе с точками и полосой прогресса
+        state = (self.current_dot_index, self.loader.progress)
+        if not self.dirty and state == self.drawn_state:
+            return []
+        self.dirty = False
+        self.drawn_state = state
 
-    def loading_screen(self):
-        duration = 3
-        start_time = time.time()
-        while time.time() - start_time < duration:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
+        surface.fill(WHITE)
+        loading_surface = text_cache.render(self.loading_text + self.dots[self.current_dot_index], 74)
+        surface.blit(loading_surface, (WIDTH // 2 - loading_surface.get_width() // 2, HEIGHT // 2 - 50))
 
-            now = pygame.time.get_ticks()
-            if now - self.last_update > self.dot_animation_speed:
-                self.current_dot_index = (self.current_dot_index + 1) % len(self.dots)
-                self.last_update = now
+        # Полоса реального прогресса загрузки уровня
+        bar_rect = pygame.Rect(WIDTH // 2 - 200, HEIGHT // 2 + 10, 400, 16)
+        pygame.draw.rect(surface, GRAY, bar_rect)
+        pygame.draw.rect(surface, BLACK, (bar_rect.x, bar_rect.y, int(bar_rect.width * self.loader.progress),
+                                          bar_rect.height))
 
-            self.draw_loading_screen()
-            self.clock.tick(FPS)
+        additional_surface = text_cache.render(self.additional_text, 36)
+        surface.blit(additional_surface, (WIDTH // 2 - additional_surface.get_width() // 2, HEIGHT // 2 + 50))
 
 
 if __name__ == "__main__":
-    StartScreen().run()
+    init_display()
+    get_records_service()  # База открывается в фоне, пока игрок в меню
+    SceneManager(StartScreen()).run()
+    if records_service is not None:
+        records_service.close()
     pygame.quit()
-    sys.exit()
\ No newline at end of file
+    sys.exit()
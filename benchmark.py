@@ -0,0 +1,267 @@
+"""Бенчмарк игрового цикла уровня без окна.
+
+Пример: python benchmark.py --ticks 3000 --script route.txt --synthetic 400x40 1000x60
+Масштабирование врагов: python benchmark.py --maps --synthetic --mob-scaling 50 200 800
+Рост карты: python benchmark.py --maps --synthetic --scaling 500x40 2000x60 8000x60 --ticks 600
+Запуск игры: python benchmark.py --startup 10
+Внутреннее разрешение: python benchmark.py --render-scale 0.5
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import Main
+from map_generator import write_synthetic_map
+
+
+def default_inputs():
+    """Простой маршрут: все время вправо, прыжок каждые 40 шагов."""
+    right = Main.INPUT_BITS[Main.pygame.K_d]
+    jump = Main.INPUT_BITS[Main.pygame.K_w]
+    return [right | jump if tick % 40 < 10 else right for tick in range(400)]
+
+
+def run_level(map_file, inputs, ticks, render=True, trace_memory=False, dump_path=None):
+    """Прогон ticks шагов уровня по сценарию ввода; перезагрузки уровня в замер не входят.
+    dump_path - файл для выгрузки времени последних кадров по фазам (CSV или JSON)."""
+    profiler = Main.Profiler(enabled=True)
+    load_start = time.perf_counter()
+    level = Main.Level(map_file, profiler=profiler)
+    load_time = time.perf_counter() - load_start
+
+    restarts = 0
+    elapsed = 0
+    gc.collect()
+    collections_before = gc.get_stats()[0]["collections"]
+    blocks_before = sys.getallocatedblocks()
+    if trace_memory:
+        tracemalloc.start()
+
+    for tick in range(ticks):
+        started = time.perf_counter()
+        profiler.begin_frame()
+        outcome = level.step(Main.KeyState(inputs[tick % len(inputs)]))
+        if render:
+            level.draw()
+        profiler.end_frame()
+        elapsed += time.perf_counter() - started
+        if outcome is not None:
+            restarts += 1
+            level.close()
+            level = Main.Level(map_file, profiler=profiler)
+
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+    if dump_path:
+        profiler.dump(dump_path)
+    profiler.set_enabled(False)
+    result = {
+        "map": os.path.basename(map_file),
+        "load_ms": load_time * 1000,
+        "ticks_per_sec": ticks / elapsed if elapsed else float("inf"),
+        "phases_us": {phase: total / profiler.frames * 1e6 for phase, total in profiler.totals.items()},
+        "gc_collections": gc.get_stats()[0]["collections"] - collections_before,
+        "net_blocks": sys.getallocatedblocks() - blocks_before,
+        "peak_bytes": peak,
+        "restarts": restarts,
+        "shapes": (level.tmx_data.tile_counts, level.tmx_data.rect_counts,
+                   (len(level.blocked_tiles.bands) + len(level.platforms.bands),
+                    level.blocked_tiles.loaded + level.platforms.loaded)),
+        "chunks": (len(level.map_renderer.chunks), level.map_renderer.baked, level.map_renderer.memory),
+        "spawned": (len(level.all_sprites), len(level.all_sprites) + len(level.spawns)),
+        "atlas": (level.tmx_data.atlas.unpacked_memory, level.tmx_data.atlas.memory, len(level.tmx_data.tiles)),
+        "asset_memory": Main.assets.memory_usage(),
+    }
+    # Атлас уровня возвращается в кэш, чтобы замеры следующих карт не копили атласы
+    level.close()
+    return result
+
+
+def run_mob_scaling(counts, ticks, directory):
+    """Время шага врагов от их числа: Mob.update по одному против MobSwarm (все враги активны)."""
+    saved = Main.ENEMY_ACTIVATION_MARGIN, Main.BATCH_ENEMIES
+    Main.ENEMY_ACTIVATION_MARGIN = 10 ** 6
+    idle = Main.KeyState(0)
+    modes = (False, True) if Main.numpy is not None else (False,)
+    try:
+        for count in counts:
+            path = os.path.join(directory, "mobs_{0}.tmx".format(count))
+            write_synthetic_map(path, max(100, count), 30, enemies=count)
+            timings = {}
+            states = {}
+            for batch in modes:
+                Main.BATCH_ENEMIES = batch
+                profiler = Main.Profiler(enabled=True)
+                level = Main.Level(path, profiler=profiler)
+                states[batch] = []
+                for tick in range(ticks):
+                    profiler.begin_frame()
+                    level.step(idle)
+                    profiler.end_frame()
+                    if tick % 10 == 0:
+                        states[batch].append(hash(tuple((enemy.rect.x, enemy.rect.y, enemy.frame_index)
+                                                        for enemy in level.enemies)))
+                profiler.set_enabled(False)
+                level.close()
+                timings[batch] = profiler.totals["enemies"] / ticks * 1e6
+            line = "mobs {0}: per-object {1:.1f} us/tick".format(count, timings[False])
+            if True in timings:
+                line += ", batched {0:.1f} us/tick (x{1:.1f}), states {2}".format(
+                    timings[True], timings[False] / timings[True],
+                    "match" if states[True] == states[False] else "DIFFER")
+            print(line)
+    finally:
+        Main.ENEMY_ACTIVATION_MARGIN, Main.BATCH_ENEMIES = saved
+
+
+def run_map_scaling(sizes, inputs, ticks, directory):
+    """Загрузка (без кэша и из кэша), память и время кадра на синтетических картах растущего размера."""
+    saved = Main.LEVEL_CACHE_DIR
+    Main.LEVEL_CACHE_DIR = os.path.join(directory, "cache")
+    print("{0:>10} {1:>9} {2:>8} {3:>8} {4:>9} {5:>9} {6:>8} {7:>8} {8:>8}".format(
+        "size", "tiles", "cold ms", "warm ms", "heap MB", "chunks MB", "avg ms", "p95 ms", "max ms"))
+    try:
+        for size in sizes:
+            width, height = (int(value) for value in size.split("x"))
+            path = os.path.join(directory, "scaling_{0}.tmx".format(size))
+            write_synthetic_map(path, width, height, enemies=width // 10, thorns=width // 100)
+            shutil.rmtree(Main.LEVEL_CACHE_DIR, ignore_errors=True)
+
+            started = time.perf_counter()
+            Main.Level(path).close()
+            cold = time.perf_counter() - started
+            gc.collect()
+            tracemalloc.start()
+            started = time.perf_counter()
+            profiler = Main.Profiler(enabled=True)
+            level = Main.Level(path, profiler=profiler)
+            warm = time.perf_counter() - started
+            heap = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            for tick in range(ticks):
+                profiler.begin_frame()
+                if level.step(Main.KeyState(inputs[tick % len(inputs)])) is not None:
+                    level.close()
+                    level = Main.Level(path, profiler=profiler)
+                level.draw()
+                profiler.end_frame()
+            frame = profiler.stats()["frame"]
+            profiler.set_enabled(False)
+            print("{0:>10} {1:>9} {2:>8.1f} {3:>8.1f} {4:>9.1f} {5:>9.1f} {6:>8.2f} {7:>8.2f} {8:>8.2f}".format(
+                size, sum(level.tmx_data.tile_counts), cold * 1000, warm * 1000, heap / 2 ** 20,
+                level.map_renderer.memory / 2 ** 20, frame["avg"], frame["p95"], frame["max"]))
+            level.close()
+    finally:
+        Main.LEVEL_CACHE_DIR = saved
+
+
+def startup_child():
+    """Запуск игры до первого показанного кадра меню; моменты этапов печатаются для родителя."""
+    marks = {"imported": time.time()}
+    Main.init_display(headless=True)
+    marks["display"] = time.time()
+    manager = Main.SceneManager(Main.StartScreen())
+    marks["scene"] = time.time()
+    manager.frame()
+    marks["first_frame"] = time.time()
+    print(json.dumps(marks))
+
+
+def run_startup(runs):
+    """Время до первого кадра в отдельных процессах, вместе с запуском интерпретатора и импортами."""
+    stages = ("imported", "display", "scene", "first_frame")
+    samples = {stage: [] for stage in stages}
+    environment = dict(os.environ, SDL_VIDEODRIVER="dummy")
+    for _ in range(runs):
+        started = time.time()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-child"], env=environment,
+                                capture_output=True, text=True, check=True).stdout
+        marks = json.loads(output.strip().splitlines()[-1])
+        for stage in stages:
+            samples[stage].append((marks[stage] - started) * 1000)
+    print("startup, median of {0} runs: ".format(runs) + ", ".join(
+        "{0} {1:.1f} ms".format(stage, statistics.median(samples[stage])) for stage in stages))
+
+
+def print_result(result):
+    print("{map}: load {load_ms:.1f} ms, {ticks_per_sec:.0f} ticks/s, restarts {restarts}".format(**result))
+    phases = ", ".join("{0} {1:.1f}".format(phase, value) for phase, value in sorted(result["phases_us"].items()))
+    print("  phases, us/tick: " + phases)
+    line = "  allocations: gen0 gc {gc_collections}, net blocks {net_blocks:+d}".format(**result)
+    if result["peak_bytes"] is not None:
+        line += ", traced peak {0:.1f} KB".format(result["peak_bytes"] / 1024)
+    print(line)
+    (blocked_tiles, platform_tiles), (blocked, platforms), (cached, loaded) = result["shapes"]
+    print("  collision shapes: blocked {0} -> {1}, platforms {2} -> {3}; bands cached {4}, loaded {5}".format(
+        blocked_tiles, blocked, platform_tiles, platforms, cached, loaded))
+    print("  map chunks: cached {0}, baked {1}, {2:.1f} MB; objects spawned {3} of {4}".format(
+        *result["chunks"][:2], result["chunks"][2] / 2 ** 20, *result["spawned"]))
+    unpacked, packed, tiles = result["atlas"]
+    print("  tile images: {0} tiles, {1:.0f} KB as tilesets and separate surfaces -> {2:.0f} KB atlas, "
+          "saved {3:.0f} KB; asset cache {4:.0f} KB".format(tiles, unpacked / 1024, packed / 1024,
+                                                             (unpacked - packed) / 1024, result["asset_memory"] / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк уровней без окна")
+    parser.add_argument("--ticks", type=int, default=3000)
+    parser.add_argument("--script", help="сценарий ввода (строки вида '120 d+w')")
+    parser.add_argument("--maps", nargs="*", default=Main.LEVELS)
+    parser.add_argument("--synthetic", nargs="*", default=["400x40", "1000x60"],
+                        help="размеры синтетических карт, ШИРИНАxВЫСОТА в тайлах")
+    parser.add_argument("--no-render", action="store_true", help="только симуляция, без отрисовки")
+    parser.add_argument("--render-scale", type=float, default=Main.RENDER_SCALE, choices=Main.RENDER_SCALES,
+                        help="масштаб внутреннего разрешения мира")
+    parser.add_argument("--mob-scaling", nargs="*", type=int, default=[],
+                        help="число врагов для сравнения поштучной и пакетной (NumPy) физики")
+    parser.add_argument("--scaling", nargs="*", default=[], metavar="WxH",
+                        help="размеры синтетических карт для таблицы загрузки, памяти и времени кадра")
+    parser.add_argument("--startup", type=int, metavar="RUNS", help="только замер времени до первого кадра")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--trace-memory", action="store_true", help="пик памяти через tracemalloc (медленно)")
+    parser.add_argument("--profile-dump", metavar="DIR",
+                        help="каталог для CSV со временем последних кадров по фазам, файл на карту")
+    args = parser.parse_args()
+    if args.startup_child:
+        startup_child()
+        return
+    if args.startup:
+        run_startup(args.startup)
+        return
+
+    Main.init_display(headless=True)
+    Main.render_governor.set_scale(args.render_scale)
+    inputs = Main.load_input_script(args.script) if args.script else default_inputs()
+
+    with tempfile.TemporaryDirectory() as directory:
+        maps = list(args.maps)
+        for size in args.synthetic:
+            width, height = (int(value) for value in size.split("x"))
+            path = os.path.join(directory, "synthetic_{0}.tmx".format(size))
+            write_synthetic_map(path, width, height, enemies=width // 10)
+            maps.append(path)
+
+        for map_file in maps:
+            dump_path = None
+            if args.profile_dump:
+                os.makedirs(args.profile_dump, exist_ok=True)
+                dump_path = os.path.join(args.profile_dump, os.path.basename(map_file) + ".csv")
+            print_result(run_level(map_file, inputs, args.ticks, not args.no_render, args.trace_memory, dump_path))
+        if args.mob_scaling:
+            run_mob_scaling(args.mob_scaling, args.ticks, directory)
+        if args.scaling:
+            run_map_scaling(args.scaling, inputs, args.ticks, directory)
+
+
+if __name__ == "__main__":
+    main()
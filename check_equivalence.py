@@ -0,0 +1,512 @@
+"""Проверка равносильности: быстрые пути игры сравниваются с простыми эталонными без окна.
+
+collisions - объединенные прямоугольники столкновений против потайловых, из состояний без пересечений
+             (совпадение требуется при скоростях, на которых тело не проскакивает тайл, см. merge_tile_rects);
+enemies    - пакетная физика врагов (MobSwarm) против Mob.update по одному в режимах "freeze" и "coarse";
+redraw     - частичная перерисовка против полной и обе против эталонного кадра со всеми спрайтами;
+atlas      - карта из атласа и чанков против тайлов, загруженных pytmx.load_pygame;
+replays    - записанный забег повторяется из байтов, файла и базы рекордов с тем же временем;
+spatial    - пространственный хеш групп против перебора всех спрайтов;
+spawns     - объекты, подгружаемые и выгружаемые по ходу камеры, против созданных при загрузке.
+
+Проверки относятся к разным оптимизациям и собраны в одном файле, чтобы их можно было прогнать разом.
+
+Пример: python check_equivalence.py
+        python check_equivalence.py --checks enemies redraw --ticks 3000 --seeds 1 2 3
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+import Main
+from map_generator import generate_map, surface_row, write_map, write_synthetic_map
+
+CHECKS = ("collisions", "enemies", "redraw", "atlas", "replays", "spatial", "spawns")
+
+
+def random_inputs(ticks, seed):
+    """Маски клавиш случайного маршрута: нажатия меняются изредка, чаще всего это бег вправо и прыжки."""
+    rng = random.Random(seed)
+    chances = ((Main.pygame.K_a, 0.25), (Main.pygame.K_d, 0.7), (Main.pygame.K_w, 0.3))
+    mask = 0
+    masks = []
+    for _ in range(ticks):
+        if rng.random() < 0.08:
+            mask = sum(Main.INPUT_BITS[key] for key, chance in chances if rng.random() < chance)
+        masks.append(mask)
+    return masks
+
+
+def level_state(level):
+    """Все, что после шага видно игроку: хорек, враги, объекты, камера и признак победы."""
+    return (tuple(level.Ferret.rect), level.Ferret.velocity_y,
+            tuple(tuple(enemy.rect) + (enemy.frame_index, enemy.direction, enemy.is_dead)
+                  for enemy in level.enemies),
+            tuple(level.tp.rect), tuple(tuple(thorn.rect) for thorn in level.thorns),
+            tuple(level.camera.camera_rect), tuple(level.princess.rect) if level.check else None,
+            level.check_win)
+
+
+def run_level(map_file, masks):
+    """Исход и состояние уровня после каждого шага до конца маршрута или до исхода."""
+    level = Main.Level(map_file)
+    log = []
+    for mask in masks:
+        outcome = level.step(Main.KeyState(mask))
+        log.append((outcome, level_state(level)))
+        if outcome is not None:
+            break
+    level.close()
+    return log
+
+
+def first_difference(ours, theirs):
+    """Первый шаг, на котором журналы расходятся, или None."""
+    for tick, (a, b) in enumerate(zip(ours, theirs)):
+        if a != b:
+            return tick
+    return None if len(ours) == len(theirs) else min(len(ours), len(theirs))
+
+
+def check_collisions(maps, probes, seed):
+    """Хорек и враг из случайных состояний без пересечений с твердыми тайлами делают один шаг
+    с объединенными прямоугольниками и с прямоугольником на каждый тайл, как до объединения.
+
+    Скорости берутся и за пределами достижимых в игре. Если за шаг тело поднимается больше чем на тайл
+    или опускается на тайл и свою высоту, оно может проскочить тайл, и исходы расходятся; такие
+    расхождения считаются отдельно и проверку не валят."""
+    failures = checked = fast = fast_differences = 0
+    for map_file in maps:
+        data = Main.load_level_data(map_file)
+        tiles = ([], [])  # Твердые тайлы и платформы по слоям, как их собирал уровень до объединения
+        for x, y, gid in data.iter_tiles():
+            if gid in data.tiles:
+                tiles[gid == 162].append((x * data.tilewidth, y * data.tileheight, data.tilewidth, data.tileheight))
+        pair = []
+        for rects in (tiles[1], tiles[0]):
+            grid = Main.CollisionGrid(data.width, data.height, data.tilewidth, data.tileheight)
+            for rect in rects:
+                grid.add(Main.pygame.Rect(rect))
+            pair.append(grid)
+        # Объединенные прямоугольники - из полос файла кэша, как их читает уровень
+        grids = [pair, data.collision_grids()]
+
+        rng = random.Random(seed)
+        width = data.width * data.tilewidth
+        height = data.height * data.tileheight
+        for _ in range(probes):
+            x, y = rng.randrange(width - data.tilewidth), rng.randrange(height - data.tileheight)
+            probe = Main.pygame.Rect(x, y, data.tilewidth, data.tileheight)
+            if probe.collidelist(grids[0][1].query(probe)) != -1:
+                continue
+            velocity = rng.randrange(-80, 80)
+            direction = rng.choice((-1, 1))
+            keys = Main.KeyState(rng.randrange(16))
+            results = []
+            for platforms, blocked in grids:
+                ferret = Main.BabyFerret(x, y, data)
+                ferret.velocity_y = velocity
+                ferret.update(keys, platforms, blocked)
+                enemy = Main.Mob(x, y, data)
+                enemy.velocity_y = velocity
+                enemy.direction = direction
+                enemy.update(keys, platforms, blocked)
+                results.append((tuple(ferret.rect), ferret.velocity_y, ferret.on_ground,
+                                tuple(enemy.rect), enemy.velocity_y, enemy.direction))
+            checked += 1
+            if -velocity > data.tileheight or velocity + Main.GRAVITY >= data.tileheight + probe.height:
+                fast += 1
+                fast_differences += results[0] != results[1]
+            elif results[0] != results[1]:
+                failures += 1
+                if failures <= 3:
+                    print("  {0}: из {1}, скорость {2}, клавиши {3}: по тайлам {4}, объединенные {5}".format(
+                        map_file, tuple(probe), velocity, keys.mask, *results))
+    print("collisions: проверено состояний {0}, расхождений {1}; из них со скоростью, при которой тело"
+          " проскакивает тайл, {2}, расходятся {3}".format(checked, failures, fast, fast_differences))
+    return failures
+
+
+def check_enemies(maps, ticks, seeds):
+    """Пакетная физика врагов против поштучной на одних и тех же маршрутах."""
+    if Main.numpy is None:
+        print("enemies: пропущено, NumPy не установлен")
+        return 0
+    saved = Main.ENEMY_INACTIVE_MODE, Main.ENEMY_ACTIVATION_MARGIN, Main.BATCH_ENEMIES
+    failures = runs = 0
+    try:
+        for mode in ("freeze", "coarse"):
+            # Обычный отступ активации и такой, при котором активны все враги
+            for margin in (saved[1], 10 ** 6):
+                Main.ENEMY_INACTIVE_MODE, Main.ENEMY_ACTIVATION_MARGIN = mode, margin
+                for seed in seeds:
+                    masks = random_inputs(ticks, seed)
+                    for map_file in maps:
+                        logs = []
+                        for batch in (False, True):
+                            Main.BATCH_ENEMIES = batch
+                            logs.append(run_level(map_file, masks))
+                        runs += 1
+                        tick = first_difference(*logs)
+                        if tick is not None:
+                            failures += 1
+                            print("  {0}: режим {1}, отступ {2}, сид {3}: расхождение на шаге {4}".format(
+                                map_file, mode, margin, seed, tick))
+    finally:
+        Main.ENEMY_INACTIVE_MODE, Main.ENEMY_ACTIVATION_MARGIN, Main.BATCH_ENEMIES = saved
+    print("enemies: прогонов {0}, расхождений {1}".format(runs, failures))
+    return failures
+
+
+def reference_frame(level, previous, surface, alpha):
+    """Эталонный кадр: вся карта под камерой и все спрайты уровня по порядку, без отсечения."""
+    camera = Main.interpolate_rect(level.previous_camera, level.camera.camera_rect, alpha)
+    surface.fill(Main.CYAN)
+    level.map_renderer.draw(surface, camera)
+    for sprite in level.all_sprites:
+        rect = Main.interpolate_rect(previous.get(sprite, sprite.rect), sprite.rect, alpha)
+        surface.blit(sprite.image, rect.move(-camera.x, -camera.y))
+
+
+def check_redraw(maps, ticks, seeds):
+    """Кадр с частичной перерисовкой и отсечением по камере, полная перерисовка и эталонный кадр
+    должны совпадать попиксельно, в том числе между шагами (интерполяция) и на кадрах без шага."""
+    pygame = Main.pygame
+    Main.render_governor.set_scale(1)
+    modes = (False, True) if Main.numpy is not None else (False,)
+    saved = Main.BATCH_ENEMIES
+    failures = frames = 0
+    try:
+        for batch in modes:
+            Main.BATCH_ENEMIES = batch
+            for seed in seeds:
+                rng = random.Random(seed)
+                for map_file in maps:
+                    level = Main.Level(map_file)
+                    surfaces = [pygame.Surface((Main.WIDTH, Main.HEIGHT)) for _ in range(3)]
+                    for tick, mask in enumerate(random_inputs(ticks, seed)):
+                        if rng.random() < 0.4:
+                            mask = 0
+                        previous = {sprite: sprite.rect.copy() for sprite in level.all_sprites}
+                        if level.step(Main.KeyState(mask)) is not None:
+                            break
+                        alpha = rng.choice((1, 1, 0.3, 0.7))
+                        level.draw(surfaces[0], alpha)
+                        saved_drawn = level.dirty, level.drawn_surface, level.drawn_camera, level.drawn_sprites
+                        level.dirty = True
+                        level.draw(surfaces[1], alpha)
+                        level.dirty, level.drawn_surface, level.drawn_camera, level.drawn_sprites = saved_drawn
+                        reference_frame(level, previous, surfaces[2], alpha)
+                        frames += 1
+                        partial, full, reference = (pygame.image.tobytes(surface, "RGB") for surface in surfaces)
+                        if partial != reference or full != reference:
+                            failures += 1
+                            print("  {0}: пакетно {1}, сид {2}, шаг {3}: {4}".format(
+                                map_file, batch, seed, tick,
+                                "полная перерисовка" if full != reference else "частичная перерисовка"))
+                            break
+                    level.close()
+    finally:
+        Main.BATCH_ENEMIES = saved
+    print("redraw: кадров {0}, расхождений {1}".format(frames, failures))
+    return failures
+
+
+def check_atlas(maps, cameras, seed):
+    """Карта, нарисованная чанками из атласа, против тайлов pytmx.load_pygame, которые рисуются по одному."""
+    from pytmx.util_pygame import load_pygame
+
+    pygame = Main.pygame
+    rng = random.Random(seed)
+    failures = checked = 0
+    for map_file in maps:
+        tmx_data = load_pygame(map_file)
+        tiles = []
+        for layer in tmx_data.visible_layers:
+            if hasattr(layer, 'data'):
+                for x, y, gid in layer:
+                    image = tmx_data.get_tile_image_by_gid(gid)
+                    if image:
+                        tiles.append((image, x * tmx_data.tilewidth, y * tmx_data.tileheight))
+        level = Main.Level(map_file)
+        width = max(1, level.camera.width - Main.WIDTH)
+        height = max(1, level.camera.height - Main.HEIGHT)
+        positions = [(0, 0), (width // 2, height // 2), (width - 1, height - 1)]
+        positions += [(rng.randrange(width), rng.randrange(height)) for _ in range(cameras)]
+        ours = pygame.Surface((Main.WIDTH, Main.HEIGHT))
+        theirs = pygame.Surface((Main.WIDTH, Main.HEIGHT))
+        for x, y in positions:
+            camera = pygame.Rect(x, y, Main.WIDTH, Main.HEIGHT)
+            ours.fill(Main.CYAN)
+            level.map_renderer.draw(ours, camera)
+            theirs.fill(Main.CYAN)
+            for image, tile_x, tile_y in tiles:
+                theirs.blit(image, (tile_x - x, tile_y - y))
+            checked += 1
+            if pygame.image.tobytes(ours, "RGB") != pygame.image.tobytes(theirs, "RGB"):
+                failures += 1
+                print("  {0}: камера в {1} рисуется иначе".format(map_file, (x, y)))
+        level.close()
+    print("atlas: положений камеры {0}, расхождений {1}".format(checked, failures))
+    return failures
+
+
+def record_run(levels, route, limit):
+    """Забег по уровням с записью повтора, как в игре: после смерти все начинается с первого уровня."""
+    replay = Main.Replay.start()
+    level_number = 0
+    total_time = 0
+    for _ in range(limit):
+        map_file = levels[level_number]
+        replay.start_level(map_file)
+        level = Main.Level(map_file)
+        outcome = None
+        for tick in range(limit):
+            mask = route(tick)
+            replay.record(mask)
+            outcome = level.step(Main.KeyState(mask))
+            if outcome is not None:
+                break
+        level.close()
+        if outcome is None:
+            return replay, None
+        if outcome == "death":
+            level_number = 0
+            continue
+        total_time += level.current_time
+        level_number += 1
+        if outcome == "win" or level_number == len(levels):
+            return replay, total_time
+    return replay, None
+
+
+def check_replays(directory):
+    """Записанный забег повторяется с тем же временем после байтов, файла и базы рекордов,
+    а испорченная запись и запись с другой частотой шагов не проходят проверку."""
+    levels = []
+    for index, width in enumerate((40, 50)):
+        path = os.path.join(directory, "replay_{0}.tmx".format(index))
+        write_synthetic_map(path, width, 20, solid_density=0, platform_density=0, seed=index)
+        levels.append(path)
+    right = Main.INPUT_BITS[Main.pygame.K_d]
+    jump = Main.INPUT_BITS[Main.pygame.K_w]
+
+    saved = Main.LEVELS
+    Main.LEVELS = levels
+    failures = []
+    try:
+        replay, claimed = record_run(levels, lambda tick: right | jump if tick % 400 < 8 else right, 10000)
+        if claimed is None:
+            failures.append("маршрут не дошел до победы")
+        else:
+            path = os.path.join(directory, "run.rpl")
+            replay.save(path)
+            copies = {"байты": Main.Replay.from_bytes(replay.to_bytes()), "файл": Main.Replay.load(path)}
+            service = Main.RecordsService(os.path.join(directory, "records.db"))
+            try:
+                service.add_record(claimed, replay)
+                service.flush()
+                rows = service.get_replays()
+            finally:
+                service.close()
+            if len(rows) != 1 or rows[0][1] != claimed:
+                failures.append("в базе рекордов {0} записей вместо одной".format(len(rows)))
+            else:
+                copies["база"] = rows[0][2]
+            for name, copy in copies.items():
+                if (copy.seed, copy.tick_rate, copy.levels) != (replay.seed, replay.tick_rate, replay.levels):
+                    failures.append("{0}: запись изменилась".format(name))
+                elif not Main.verify_replay(copy, claimed):
+                    failures.append("{0}: повтор дал {1} вместо {2}".format(
+                        name, Main.simulate_replay(copy)[1], claimed))
+
+            tampered = Main.Replay.from_bytes(replay.to_bytes())
+            tampered.levels[0][1][5] ^= right
+            tampered.levels[0][1].append(0)
+            if Main.verify_replay(tampered, claimed):
+                failures.append("испорченная запись прошла проверку")
+            other_rate = Main.Replay(replay.seed, Main.TICK_RATE // 2, replay.levels)
+            if Main.simulate_replay(other_rate)[1] is not None:
+                failures.append("запись с другой частотой шагов прошла проверку")
+    finally:
+        Main.LEVELS = saved
+    for failure in failures:
+        print("  " + failure)
+    print("replays: расхождений {0}".format(len(failures)))
+    return len(failures)
+
+
+def check_spatial(maps, ticks, seeds):
+    """Ответы пространственного хеша групп на каждом шаге против перебора всех спрайтов группы."""
+    failures = queries = 0
+    for seed in seeds:
+        for map_file in maps:
+            level = Main.Level(map_file)
+            groups = (level.all_sprites, level.enemies, level.thorns, level.teleports, level.princesses)
+            for tick, mask in enumerate(random_inputs(ticks, seed)):
+                outcome = level.step(Main.KeyState(mask))
+                probes = (level.Ferret.rect, level.Ferret.rect.inflate(300, 300), level.camera.camera_rect)
+                for group in groups:
+                    for probe in probes:
+                        queries += 1
+                        if group.collide(probe) != [sprite for sprite in group if probe.colliderect(sprite.rect)]:
+                            failures += 1
+                            if failures <= 3:
+                                print("  {0}: сид {1}, шаг {2}, область {3}".format(map_file, seed, tick, tuple(probe)))
+                if outcome is not None:
+                    break
+            level.close()
+    print("spatial: запросов {0}, расхождений {1}".format(queries, failures))
+    return failures
+
+
+def write_spawns_map(path, seed):
+    """Карта для проверки подгрузки: хорек начинает посередине, шипы и враги висят в воздухе, левее
+    старта часть шипов стоит над ямами без дна, а лишние хорьки, телепорты и принцессы - украшения."""
+    rng = random.Random(seed)
+    grid, objects = generate_map(300, 30, solid_density=0.005, platform_density=0.1, enemies=30, thorns=40,
+                                 teleports=4, players=2, princesses=3, seed=seed)
+    # Второй хорек - игрок, первый остается украшением у края карты
+    start = 150
+    objects[1] = ("Player", start * 32, (surface_row(grid, start, 1) - 1) * 32)
+    objects = [(name, x, y - rng.randrange(8) * 32 if name in ("Shipi", "Enemy") else y)
+               for name, x, y in objects
+               if name not in ("Shipi", "Enemy") or abs(x - start * 32) > 20 * 32]
+    for name, x, y in objects:
+        if name == "Shipi" and x < (start - 40) * 32 and rng.random() < 0.3:
+            for row in grid:
+                row[x // 32] = 0
+    write_map(path, grid, objects)
+
+
+def mirrored(masks):
+    """Тот же маршрут в другую сторону: клавиши влево и вправо меняются местами."""
+    left, right = Main.INPUT_BITS[Main.pygame.K_a], Main.INPUT_BITS[Main.pygame.K_d]
+    return [mask & ~(left | right) | (left if mask & right else 0) | (right if mask & left else 0)
+            for mask in masks]
+
+
+def spawns_state(level, area, outcome):
+    """Исход, хорек, цели, камера и все объекты, стоящие по горизонтали в области area."""
+    near = [(sprite.spawn_order, tuple(sprite.rect), sprite.image) for sprite in level.all_sprites
+            if sprite.rect.right > area.left and sprite.rect.left < area.right]
+    return (outcome, level_state(level)[:2], tuple(level.tp.rect), tuple(level.camera.camera_rect),
+            tuple(level.princess.rect) if level.check else None, level.check_win, near)
+
+
+def run_spawns(map_file, masks, surfaces):
+    """Маршрут одновременно по уровню с подгрузкой объектов и по уровню со всеми объектами сразу.
+    Возвращает шаг первого расхождения (или None) и сколько объектов подгруженный уровень выгрузил."""
+    levels = []
+    for stream in (True, False):
+        Main.STREAM_SPAWNS = stream
+        levels.append(Main.Level(map_file))
+    spawned = set()
+    difference = None
+    for tick, mask in enumerate(masks):
+        # Подгружаются объекты области до шага: после него сравнивается она же
+        area = levels[0].activation_area()
+        states = [spawns_state(level, area, level.step(Main.KeyState(mask))) for level in levels]
+        spawned.update(sprite.spawn_order for sprite in levels[0].all_sprites)
+        same = states[0] == states[1]
+        if same and tick % 10 == 0:
+            for level, surface in zip(levels, surfaces):
+                level.dirty = True
+                level.draw(surface, 1)
+            same = Main.pygame.image.tobytes(surfaces[0], "RGB") == Main.pygame.image.tobytes(surfaces[1], "RGB")
+        if not same:
+            difference = tick
+            break
+        if states[0][0] is not None:
+            break
+    despawned = sum(order in spawned for _, order, _, _, _ in levels[0].spawns)
+    for level in levels:
+        level.close()
+    return difference, despawned
+
+
+def check_spawns(maps, ticks, seeds, directory):
+    """Уровень с подгрузкой объектов (STREAM_SPAWNS) против уровня, где все объекты созданы при загрузке:
+    на каждом шаге совпадают исход, хорек, камера, цели и все объекты у камеры, а кадры - попиксельно."""
+    path = os.path.join(directory, "spawns.tmx")
+    write_spawns_map(path, seeds[0])
+    modes = (False, True) if Main.numpy is not None else (False,)
+    saved = Main.STREAM_SPAWNS, Main.BATCH_ENEMIES, Main.DESPAWN_MARGIN, Main.DESPAWN_INTERVAL
+    surfaces = [Main.pygame.Surface((Main.WIDTH, Main.HEIGHT)) for _ in range(2)]
+    failures = runs = despawned = 0
+    try:
+        # Обычная выгрузка и выгрузка на каждом шаге сразу за областью активации
+        for batch, (Main.DESPAWN_MARGIN, Main.DESPAWN_INTERVAL) in itertools.product(modes, (saved[2:], (0, 1))):
+            Main.BATCH_ENEMIES = batch
+            for seed in seeds:
+                for map_file in list(maps) + [path]:
+                    masks = random_inputs(ticks, seed)
+                    routes = [masks]
+                    if map_file == path:
+                        # По карте подгрузки хорек идет от середины в обе стороны и возвращается назад,
+                        # к выгруженным объектам
+                        half = ticks // 2
+                        routes += [mirrored(masks), masks[:half] + mirrored(masks[half:])]
+                    for route in routes:
+                        tick, count = run_spawns(map_file, route, surfaces)
+                        runs += 1
+                        despawned += count
+                        if tick is not None:
+                            failures += 1
+                            print("  {0}: пакетно {1}, запас выгрузки {2}, сид {3}: расхождение на шаге {4}".format(
+                                map_file, batch, Main.DESPAWN_MARGIN, seed, tick))
+    finally:
+        Main.STREAM_SPAWNS, Main.BATCH_ENEMIES, Main.DESPAWN_MARGIN, Main.DESPAWN_INTERVAL = saved
+    print("spawns: прогонов {0}, выгружено объектов {1}, расхождений {2}".format(runs, despawned, failures))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка равносильности быстрых путей игры и эталонных")
+    parser.add_argument("--checks", nargs="*", default=CHECKS, choices=CHECKS)
+    parser.add_argument("--maps", nargs="*", default=Main.LEVELS)
+    parser.add_argument("--ticks", type=int, default=1500, help="шагов на маршрут")
+    parser.add_argument("--seeds", nargs="*", type=int, default=[1, 2], help="сиды случайных маршрутов")
+    parser.add_argument("--probes", type=int, default=20000, help="случайных состояний на карту для collisions")
+    parser.add_argument("--cameras", type=int, default=5, help="случайных положений камеры на карту для atlas")
+    args = parser.parse_args()
+
+    Main.init_display(headless=True)
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        saved_cache = Main.LEVEL_CACHE_DIR
+        Main.LEVEL_CACHE_DIR = os.path.join(directory, "cache")
+        # Синтетическая карта добавляет много шипов и врагов рядом друг с другом
+        crowded = os.path.join(directory, "crowded.tmx")
+        write_synthetic_map(crowded, 200, 30, enemies=40, thorns=40, seed=4)
+        maps = list(args.maps) + [crowded]
+        try:
+            for name in args.checks:
+                started = time.perf_counter()
+                if name == "collisions":
+                    failures += check_collisions(maps, args.probes, args.seeds[0])
+                elif name == "enemies":
+                    failures += check_enemies(maps, args.ticks, args.seeds)
+                elif name == "redraw":
+                    failures += check_redraw(maps, args.ticks, args.seeds)
+                elif name == "atlas":
+                    failures += check_atlas(maps, args.cameras, args.seeds[0])
+                elif name == "replays":
+                    failures += check_replays(directory)
+                elif name == "spatial":
+                    failures += check_spatial(maps, args.ticks, args.seeds)
+                elif name == "spawns":
+                    failures += check_spawns(maps, args.ticks, args.seeds, directory)
+                print("  {0:.1f} сек".format(time.perf_counter() - started))
+        finally:
+            Main.LEVEL_CACHE_DIR = saved_cache
+    print("расхождений всего: {0}".format(failures))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
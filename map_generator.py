@@ -0,0 +1,134 @@
+"""Генератор больших TMX-карт для проверки загрузки и масштабирования уровней.
+
+Карта строится на тайлсете игры: пол во всю ширину, случайные твердые блоки и висячие площадки,
+объекты Player, Teleport, Enemy, Shipi и Princess стоят на поверхности земли.
+
+Пример: python map_generator.py big.tmx --width 4000 --height 60 --enemies 400 --thorns 40
+"""
+import argparse
+import os
+import random
+
+# Тайлсет ищется рядом со скриптом, а не в текущей папке
+TILESET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps",
+                       "tiles2.thumb.png.65dffda5d728405d4cf56e14a9d31e18.tsx")
+TILE_SIZE = 32
+GROUND_GID = 162  # Тайл земли, как на уровнях игры
+FLOOR_ROWS = 3
+SAFE_COLUMNS = 10  # Столбцы у старта игрока без врагов и шипов
+
+
+def generate_map(width, height, solid_density=0.02, platform_density=0.25, enemies=0, thorns=0,
+                 teleports=1, players=1, princesses=0, seed=0):
+    """Сетка тайлов (список строк) и объекты [(имя, x, y)] в пикселях.
+
+    solid_density - доля клеток над полом, занятых твердыми блоками;
+    platform_density - число висячих площадок на столбец карты."""
+    if width < SAFE_COLUMNS + 5 or height < FLOOR_ROWS + 8:
+        raise ValueError("карта слишком мала: нужно не меньше {0}x{1} тайлов".format(SAFE_COLUMNS + 5,
+                                                                                      FLOOR_ROWS + 8))
+    rng = random.Random(seed)
+    grid = [[0] * width for _ in range(height)]
+    for y in range(height - FLOOR_ROWS, height):
+        grid[y] = [GROUND_GID] * width
+
+    # Блоки стоят на полу или друг на друге, чтобы по карте можно было пройти
+    open_cells = width * (height - FLOOR_ROWS)
+    placed = 0
+    attempts = 0
+    while placed < solid_density * open_cells and attempts < open_cells:
+        attempts += 1
+        block_width = rng.randint(1, 4)
+        block_height = rng.randint(1, 3)
+        x = rng.randrange(SAFE_COLUMNS, width - block_width)
+        top = surface_row(grid, x, block_width) - block_height
+        if top < height // 2:
+            continue
+        for y in range(top, top + block_height):
+            for dx in range(block_width):
+                placed += not grid[y][x + dx]
+                grid[y][x + dx] = GROUND_GID
+
+    for _ in range(int(width * platform_density)):
+        x = rng.randrange(width - 6)
+        y = rng.randrange(height // 2, height - FLOOR_ROWS - 3)
+        for dx in range(rng.randint(2, 6)):
+            grid[y][x + dx] = GROUND_GID
+
+    objects = []
+
+    def place(name, x):
+        objects.append((name, x * TILE_SIZE, (surface_row(grid, x, 1) - 1) * TILE_SIZE))
+
+    for _ in range(players):
+        place("Player", 2)
+    for index in range(teleports):
+        # Первый телепорт в конце карты, остальные равномерно по пути к нему
+        place("Teleport", width - 3 - index * (width - SAFE_COLUMNS) // teleports)
+    for _ in range(princesses):
+        place("Princess", rng.randrange(SAFE_COLUMNS, width - 5))
+    for _ in range(enemies):
+        place("Enemy", rng.randrange(SAFE_COLUMNS, width - 5))
+    for _ in range(thorns):
+        place("Shipi", rng.randrange(SAFE_COLUMNS, width - 5))
+    return grid, objects
+
+
+def surface_row(grid, x, width):
+    """Верхняя твердая строка под столбцами x..x+width-1 (самая высокая из них)."""
+    return min(next(y for y, row in enumerate(grid) if row[column]) for column in range(x, x + width))
+
+
+def write_map(path, grid, objects, tileset=TILESET):
+    """Запись сетки и объектов в TMX с тайлсетом по относительному пути, если он возможен."""
+    if not os.path.isfile(tileset):
+        raise FileNotFoundError("тайлсет не найден: {0}".format(tileset))
+    height = len(grid)
+    width = len(grid[0])
+    try:
+        source = os.path.relpath(tileset, os.path.dirname(os.path.abspath(path)))
+    except ValueError:  # Другой диск в Windows
+        source = tileset
+    rows = ",\n".join(",".join(str(gid) for gid in row) for row in grid)
+    lines = ['  <object id="{0}" name="{1}" x="{2}" y="{3}"/>'.format(index + 1, name, x, y)
+             for index, (name, x, y) in enumerate(objects)]
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        file.write('<map version="1.10" orientation="orthogonal" renderorder="right-down" width="{0}" height="{1}" '
+                   'tilewidth="{2}" tileheight="{2}" infinite="0" nextlayerid="3" nextobjectid="{3}">\n'
+                   .format(width, height, TILE_SIZE, len(objects) + 1))
+        file.write(' <tileset firstgid="1" source="{0}"/>\n'.format(source))
+        file.write(' <layer id="1" name="Tiles" width="{0}" height="{1}">\n'.format(width, height))
+        file.write('  <data encoding="csv">\n{0}\n</data>\n </layer>\n'.format(rows))
+        file.write(' <objectgroup id="2" name="Objects">\n{0}\n </objectgroup>\n</map>\n'.format("\n".join(lines)))
+
+
+def write_synthetic_map(path, width, height, **options):
+    """Генерация и запись карты за один вызов; options - параметры generate_map."""
+    write_map(path, *generate_map(width, height, **options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетической TMX-карты")
+    parser.add_argument("path", help="файл карты .tmx")
+    parser.add_argument("--width", type=int, default=1000, help="ширина в тайлах")
+    parser.add_argument("--height", type=int, default=40, help="высота в тайлах")
+    parser.add_argument("--solid", type=float, default=0.02, help="доля клеток над полом под твердыми блоками")
+    parser.add_argument("--platforms", type=float, default=0.25, help="висячих площадок на столбец")
+    parser.add_argument("--enemies", type=int, default=100)
+    parser.add_argument("--thorns", type=int, default=0)
+    parser.add_argument("--teleports", type=int, default=1)
+    parser.add_argument("--players", type=int, default=1)
+    parser.add_argument("--princesses", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    grid, objects = generate_map(args.width, args.height, args.solid, args.platforms, args.enemies, args.thorns,
+                                 args.teleports, args.players, args.princesses, args.seed)
+    write_map(args.path, grid, objects)
+    print("{0}: {1}x{2} тайлов, твердых {3}, объектов {4}".format(
+        args.path, args.width, args.height, sum(bool(gid) for row in grid for gid in row), len(objects)))
+
+
+if __name__ == "__main__":
+    main()
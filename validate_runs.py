@@ -0,0 +1,196 @@
+"""Регрессионная проверка маршрутов: прогоны без окна параллельно на всех ядрах.
+
+Маршрут - файл повтора (.rpl) или сценарий ввода (строки вида "120 d+w"). Нажатия проигрываются
+одним потоком с первого уровня по правилам игры: после смерти игра начинается заново.
+Для каждого маршрута сообщается, пройдена ли игра, время, число смертей и, если задан эталон,
+шаг, на котором положение хорька впервые разошлось с эталонным прогоном.
+
+Пример: python validate_runs.py routes/*.txt --save-baseline baseline.json
+        python validate_runs.py routes/*.txt --baseline baseline.json --set GRAVITY=2
+"""
+import argparse
+import ast
+import base64
+import json
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+
+import Main
+
+
+def init_worker(levels, overrides):
+    """Окно в каждом процессе свое, а константы физики подменяются до первого прогона."""
+    Main.init_display(headless=True)
+    Main.LEVELS = list(levels)
+    for name, value in overrides.items():
+        setattr(Main, name, value)
+
+
+def load_route(path):
+    """Маски клавиш маршрута по шагам; у повтора попытки склеиваются в один поток."""
+    if path.endswith(".rpl"):
+        masks = array('B')
+        for _, inputs in Main.Replay.load(path).levels:
+            masks.extend(inputs)
+        return masks
+    return Main.load_input_script(path)
+
+
+def run_route(path):
+    """Прохождение игры по маршруту. Положение хорька на каждом шаге нужно для поиска расхождений."""
+    started = time.perf_counter()
+    masks = load_route(path)
+    level_number = 0
+    level = Main.Level(Main.LEVELS[level_number])
+    total_time = 0
+    deaths = 0
+    completed = False
+    trace = array('i')
+    for mask in masks:
+        outcome = level.step(Main.KeyState(mask))
+        trace.extend(level.Ferret.rect.topleft)
+        if outcome is None:
+            continue
+        level.close()
+        if outcome == "death":
+            deaths += 1
+            level_number = 0
+        else:
+            total_time += level.current_time
+            if outcome == "next":
+                level_number += 1
+            if outcome == "win" or level_number == len(Main.LEVELS):
+                completed = True
+                break
+        level = Main.Level(Main.LEVELS[level_number])
+    return {
+        "route": path,
+        "completed": completed,
+        "time": total_time if completed else None,
+        "deaths": deaths,
+        "level": level_number,
+        "ticks": len(trace) // 2,
+        "elapsed": time.perf_counter() - started,
+        "trace": base64.b64encode(trace.tobytes()).decode("ascii"),
+    }
+
+
+def divergence(result, reference):
+    """Первый шаг, на котором положение хорька отличается от эталона: (шаг, наше, эталонное) или None."""
+    ours = array('i', base64.b64decode(result["trace"]))
+    theirs = array('i', base64.b64decode(reference["trace"]))
+    for index in range(0, min(len(ours), len(theirs)), 2):
+        if ours[index:index + 2] != theirs[index:index + 2]:
+            return index // 2, tuple(ours[index:index + 2]), tuple(theirs[index:index + 2])
+    if len(ours) != len(theirs):
+        index = min(len(ours), len(theirs))
+        return index // 2, tuple(ours[index:index + 2]) or None, tuple(theirs[index:index + 2]) or None
+    return None
+
+
+def report(result, reference):
+    """Строка отчета по маршруту и признак регрессии относительно эталона."""
+    line = "{0}: ".format(result["route"])
+    if result["completed"]:
+        line += "пройдено за {0:.2f} сек".format(result["time"])
+    else:
+        line += "не пройдено, остановился на уровне {0}".format(result["level"] + 1)
+    line += ", смертей {0}, шагов {1}".format(result["deaths"], result["ticks"])
+    if reference is None:
+        return line, False
+
+    regressed = reference["completed"] and not result["completed"]
+    if result["completed"] and reference["completed"]:
+        line += ", {0:+.2f} сек к эталону".format(result["time"] - reference["time"])
+    point = divergence(result, reference)
+    if point is None:
+        line += ", совпадает с эталоном"
+    else:
+        line += ", расхождение на шаге {0}: хорек {1}, в эталоне {2}".format(*point)
+    if regressed:
+        line += "  <-- РЕГРЕССИЯ"
+    return line, regressed
+
+
+# Частота шагов фиксирована: скорости заданы на шаг, и с другой частотой маршрут шел бы в другом темпе.
+# Остальные константы Main читаются только как значения аргументов по умолчанию при импорте модуля,
+# поэтому подмена в процессе-исполнителе до них уже не доходит
+FIXED_CONSTANTS = {"TICK_RATE", "CHUNK_SIZE", "CHUNK_CACHE_BUDGET", "CHUNK_PREFETCH", "COLLISION_BAND",
+                   "COLLISION_BAND_BUDGET",
+                   "SPATIAL_CELL", "PROFILER_HISTORY", "TEXT_CACHE_BUDGET", "RENDER_SCALES", "RENDER_SCALE",
+                   "ADAPTIVE_RESOLUTION", "GOVERNOR_WINDOW", "RECORDS_DB", "LEADERBOARD_SIZE",
+                   "LOADING_MIN_DURATION"}
+
+
+def parse_override(text):
+    name, _, value = text.partition("=")
+    if not hasattr(Main, name):
+        raise argparse.ArgumentTypeError("нет такой константы: {0}".format(name))
+    if name in FIXED_CONSTANTS:
+        raise argparse.ArgumentTypeError("константу {0} подменить нельзя".format(name))
+    # Значение разбирается как литерал Python: "False" - ложь, а не непустая строка.
+    # Строковые константы можно задавать и без кавычек
+    current = getattr(Main, name)
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        if not isinstance(current, str):
+            raise argparse.ArgumentTypeError("значение {0} не литерал Python: {1}".format(name, value))
+        parsed = value
+    numbers = (int, float)
+    if type(parsed) is not type(current) and not (
+            type(current) in numbers and type(parsed) in numbers):
+        raise argparse.ArgumentTypeError("{0} должна быть {1}, а не {2}".format(
+            name, type(current).__name__, type(parsed).__name__))
+    return name, parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельная проверка маршрутов по уровням")
+    parser.add_argument("routes", nargs="+", help="файлы повторов (.rpl) или сценариев ввода")
+    parser.add_argument("--levels", nargs="*", default=Main.LEVELS, help="уровни игры по порядку")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--set", dest="overrides", action="append", type=parse_override, default=[],
+                        metavar="NAME=VALUE", help="подменить константу Main, например GRAVITY=2")
+    parser.add_argument("--baseline", help="JSON с эталонными результатами для сравнения")
+    parser.add_argument("--save-baseline", metavar="PATH", help="сохранить результаты как эталон")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = {result["route"]: result for result in json.load(file)}
+
+    # Кэш скомпилированных уровней собирается заранее, а не одновременно в каждом процессе
+    for map_file in args.levels:
+        Main.load_level_data(map_file)
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(args.processes, init_worker, (args.levels, dict(args.overrides))) as pool:
+        results = pool.map(run_route, args.routes, chunksize=1)
+        # SDL в процессах перехватывает SIGTERM, поэтому пул закрывается штатно, а не через terminate()
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+
+    regressions = 0
+    for result in results:
+        line, regressed = report(result, baseline.get(result["route"]))
+        regressions += regressed
+        print(line)
+    simulated = sum(result["ticks"] for result in results) / Main.TICK_RATE
+    print("маршрутов {0}, пройдено {1}, регрессий {2}; {3:.1f} сек игры за {4:.1f} сек на {5} процессах".format(
+        len(results), sum(result["completed"] for result in results), regressions, simulated, elapsed,
+        args.processes))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Проверка рекордов по повторам: каждый забег заново симулируется без окна и ожидания кадров.
+
+Пример: python verify_replays.py                   # все рекорды с повторами из records.db
+        python verify_replays.py run1.rpl run2.rpl  # файлы повторов
+        python verify_replays.py --export replays   # выгрузить повторы из базы в файлы
+"""
+import argparse
+import os
+import sys
+import time
+
+import Main
+
+
+def check(name, replay, claimed_time=None):
+    """Повтор одной записи; печатает результат и возвращает, сошлось ли время."""
+    started = time.perf_counter()
+    attempts, simulated_time = Main.simulate_replay(replay)
+    elapsed = time.perf_counter() - started
+    ticks = sum(level_ticks for _, _, level_ticks in attempts)
+    speed = ticks / replay.tick_rate / elapsed if elapsed else float("inf")
+    deaths = sum(outcome == "death" for _, outcome, _ in attempts)
+
+    if simulated_time is None:
+        status = "INVALID"
+        details = "запись не сходится с игрой"
+        if attempts:
+            details += " (последняя попытка: {0}, исход {1}, шагов {2})".format(*attempts[-1])
+    elif claimed_time is not None and abs(simulated_time - claimed_time) > 1e-6:
+        status = "MISMATCH"
+        details = "заявлено {0:.2f} сек, по повтору {1:.2f} сек".format(claimed_time, simulated_time)
+    else:
+        status = "OK"
+        details = "{0:.2f} сек".format(simulated_time)
+    print("{0}: {1} {2}; попыток {3}, смертей {4}, повтор в {5:.0f} раз быстрее реального времени".format(
+        name, status, details, len(attempts), deaths, speed))
+    return status == "OK"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка рекордов по повторам")
+    parser.add_argument("files", nargs="*", help="файлы повторов; без них проверяется база рекордов")
+    parser.add_argument("--db", default=Main.RECORDS_DB)
+    parser.add_argument("--export", metavar="DIR", help="сохранить повторы из базы в файлы и выйти")
+    args = parser.parse_args()
+
+    Main.init_display(headless=True)
+    results = []
+    if args.files:
+        for path in args.files:
+            results.append(check(path, Main.Replay.load(path)))
+    else:
+        service = Main.RecordsService(args.db)
+        try:
+            replays = service.get_replays()
+        finally:
+            service.close()
+        if args.export:
+            os.makedirs(args.export, exist_ok=True)
+            for record_id, _, replay in replays:
+                replay.save(os.path.join(args.export, "record_{0}.rpl".format(record_id)))
+            print("сохранено повторов: {0}".format(len(replays)))
+            return
+        for record_id, claimed_time, replay in replays:
+            results.append(check("рекорд {0}".format(record_id), replay, claimed_time))
+
+    print("проверено {0}, не сошлось {1}".format(len(results), results.count(False)))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()